@@ -20,6 +20,7 @@ from __future__ import print_function
 
 import collections
 import re
+import threading
 import unicodedata
 import six
 import tensorflow as tf
@@ -158,16 +159,107 @@ def whitespace_tokenize(text):
   return tokens
 
 
+class LRUCache(object):
+  """Bounded least-recently-used mapping with hit/miss counters."""
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self._data = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      value = self._data.get(key)
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self._data.move_to_end(key)
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      self._data[key] = value
+      self._data.move_to_end(key)
+      if len(self._data) > self.capacity:
+        self._data.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def __len__(self):
+    return len(self._data)
+
+  def __str__(self):
+    lookups = self.hits + self.misses
+    return "hits %d, misses %d (%.1f%% hit rate), size %d/%d" % (
+        self.hits, self.misses, 100.0 * self.hits / max(lookups, 1),
+        len(self._data), self.capacity)
+
+
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, cache_size=0):
+    """Constructs a FullTokenizer.
+
+    Args:
+      vocab_file: Vocabulary file.
+      do_lower_case: Whether to lower case the input.
+      cache_size: Maximum number of entries in each of the word and text
+        caches mapping input strings to their WordPiece tokens. Caching is
+        disabled if 0.
+    """
     self.vocab = load_vocab(vocab_file)
     self.inv_vocab = {v: k for k, v in self.vocab.items()}
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
     self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    if cache_size:
+      self.word_cache = LRUCache(cache_size)
+      self.text_cache = LRUCache(cache_size)
+    else:
+      self.word_cache = None
+      self.text_cache = None
 
   def tokenize(self, text):
+    if self.word_cache is None:
+      return self._tokenize(text)
+
+    # Cleanup can join or split words, so it is applied to the whole text
+    # before the cache lookup. Everything after it works word by word.
+    text = self.basic_tokenizer.clean_text(text)
+    split_tokens = []
+    for word in whitespace_tokenize(text):
+      sub_tokens = self.word_cache.get(word)
+      if sub_tokens is None:
+        sub_tokens = self._tokenize(word)
+        self.word_cache.put(word, sub_tokens)
+      split_tokens.extend(sub_tokens)
+
+    return split_tokens
+
+  def tokenize_text(self, text):
+    """Tokenizes a string that is expected to recur as a whole."""
+    if self.text_cache is None:
+      return self.tokenize(text)
+
+    split_tokens = self.text_cache.get(text)
+    if split_tokens is None:
+      split_tokens = self.tokenize(text)
+      self.text_cache.put(text, split_tokens)
+    return list(split_tokens)
+
+  def cache_info(self):
+    if self.word_cache is None:
+      return "disabled"
+    return "words: %s; texts: %s" % (self.word_cache, self.text_cache)
+
+  def _tokenize(self, text):
     split_tokens = []
     for token in self.basic_tokenizer.tokenize(text):
       for sub_token in self.wordpiece_tokenizer.tokenize(token):
@@ -193,10 +285,13 @@ class BasicTokenizer(object):
     """
     self.do_lower_case = do_lower_case
 
+  def clean_text(self, text):
+    """Converts text to unicode and applies whitespace and character cleanup."""
+    return self._clean_text(convert_to_unicode(text))
+
   def tokenize(self, text):
     """Tokenizes a piece of text."""
-    text = convert_to_unicode(text)
-    text = self._clean_text(text)
+    text = self.clean_text(text)
 
     # This was added on November 1st, 2018 for the multilingual and Chinese
     # models. This is also applied to the English models now, but it doesn't
@@ -300,10 +395,16 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
-  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200):
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200,
+               use_trie=True):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    self.use_trie = use_trie
+    if use_trie:
+      self.trie = WordpieceTrie(vocab)
+    else:
+      self.trie = None
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -332,32 +433,94 @@ class WordpieceTokenizer(object):
         output_tokens.append(self.unk_token)
         continue
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
-          break
-        sub_tokens.append(cur_substr)
-        start = end
+      if self.trie is not None:
+        sub_tokens = self.trie.tokenize(token)
+      else:
+        sub_tokens = self._tokenize_substr(chars)
 
-      if is_bad:
+      if sub_tokens is None:
         output_tokens.append(self.unk_token)
       else:
         output_tokens.extend(sub_tokens)
     return output_tokens
 
+  def _tokenize_substr(self, chars):
+    """Greedy longest-match-first by substring lookup, None if no match."""
+    start = 0
+    sub_tokens = []
+    while start < len(chars):
+      end = len(chars)
+      cur_substr = None
+      while start < end:
+        substr = "".join(chars[start:end])
+        if start > 0:
+          substr = "##" + substr
+        if substr in self.vocab:
+          cur_substr = substr
+          break
+        end -= 1
+      if cur_substr is None:
+        return None
+      sub_tokens.append(cur_substr)
+      start = end
+    return sub_tokens
+
+
+class WordpieceTrie(object):
+  """Prefix trie over a WordPiece vocabulary for longest-match lookup.
+
+  Word-initial pieces and "##" continuation pieces are kept in separate
+  tries so that each match is a single walk from the current position
+  instead of a substring lookup for every candidate end position.
+  """
+
+  _END = None    # key marking a node that completes a vocabulary entry
+
+  def __init__(self, vocab, prefix="##"):
+    self.prefix = prefix
+    self.initial = {}
+    self.continuation = {}
+    for piece in vocab:
+      if not piece:
+        continue
+      self._add(self.initial, piece, piece)
+      if piece.startswith(prefix) and len(piece) > len(prefix):
+        self._add(self.continuation, piece[len(prefix):], piece)
+
+  def _add(self, root, key, piece):
+    node = root
+    for char in key:
+      node = node.setdefault(char, {})
+    node[self._END] = piece
+
+  def tokenize(self, word):
+    """Returns the greedy longest-match-first pieces of `word`.
+
+    Returns None if some position of `word` has no matching piece,
+    mirroring the [UNK] handling of `WordpieceTokenizer`.
+    """
+    end_key = self._END
+    start = 0
+    length = len(word)
+    sub_tokens = []
+    root = self.initial
+    while start < length:
+      node = root
+      match, match_end = None, start
+      for i in range(start, length):
+        node = node.get(word[i])
+        if node is None:
+          break
+        piece = node.get(end_key)
+        if piece is not None:
+          match, match_end = piece, i + 1
+      if match is None:
+        return None
+      sub_tokens.append(match)
+      start = match_end
+      root = self.continuation
+    return sub_tokens
+
 
 def _is_whitespace(char):
   """Checks whether `chars` is a whitespace character."""
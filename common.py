@@ -4,17 +4,29 @@ import sys
 import os
 import re
 import json
-
+import random
+import mmap
+import hashlib
+import threading
+import shutil
+import sqlite3
+import tempfile
+import resource
+import multiprocessing
+
+import h5py
 import numpy as np
 import tensorflow as tf
 
 os.environ['TF_KERAS'] = '1'
 
 from itertools import count
+from collections import deque, OrderedDict
 from functools import wraps
 from time import time
 from argparse import ArgumentParser
 from logging import info, warning
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from tensorflow import keras
 import bert_tokenization as tokenization
@@ -29,6 +41,9 @@ from tensorflow.keras.callbacks import Callback
 from config import DEFAULT_SEQ_LEN, DEFAULT_BATCH_SIZE, DEFAULT_EPOCHS
 from config import DEFAULT_LR, DEFAULT_WARMUP_PROPORTION
 from config import DEFAULT_MAX_CHECKPOINTS, CHECKPOINT_NAME
+from config import DEFAULT_TOKENIZER_CACHE_SIZE, DEFAULT_SHUFFLE_BUFFER_SIZE
+from config import DEFAULT_LOG_INTERVAL
+from config import DEFAULT_DISTILL_TEMPERATURE, DEFAULT_DISTILL_ALPHA
 
 
 def print_versions(out=sys.stderr):
@@ -52,7 +67,7 @@ def argument_parser(mode):
     if mode == 'train':
         argparser.add_argument(
             '--train_data', required=True,
-            help='Training data'
+            help='Training data (comma-separated list for multiple files)'
         )
         argparser.add_argument(
             '--labels', required=True,
@@ -60,7 +75,7 @@ def argument_parser(mode):
         )
         argparser.add_argument(
             '--dev_data', default=None,
-            help='Development data'
+            help='Development data (.tsv or comma-separated .tfrecord files)'
         )
         argparser.add_argument(
             '--task_name', default="NER",
@@ -86,6 +101,10 @@ def argument_parser(mode):
             '--output-layer', default='-1',
             help='BERT output layer (int, -1 for last, "avg", or "concat")'
         )
+        argparser.add_argument(
+            '--output_position_only', default=False, action='store_true',
+            help='Compute BERT output layer only at the classified position'
+        )
         argparser.add_argument(
             '--do_lower_case', default=False, action='store_true',
             help='Lower case input text (for uncased models)'
@@ -98,6 +117,10 @@ def argument_parser(mode):
             '--num_train_epochs', type=int, default=DEFAULT_EPOCHS,
             help='Number of training epochs'
         )
+        argparser.add_argument(
+            '--gradient_accumulation_steps', type=int, default=1,
+            help='Number of --batch_size micro-batches per optimizer update'
+        )
         argparser.add_argument(
             '--warmup_proportion', type=float, default=DEFAULT_WARMUP_PROPORTION,
             help='Proportion of training to perform LR warmup for'
@@ -126,14 +149,159 @@ def argument_parser(mode):
             '--max_checkpoints', type=int, default=DEFAULT_MAX_CHECKPOINTS,
             help='Maximum number of checkpoints to store'
         )
+        argparser.add_argument(
+            '--checkpoint_format', default='model',
+            choices=('model', 'weights', 'weights+optimizer'),
+            help='Save full model, model weights, or weights and optimizer '
+            'state in checkpoints'
+        )
+        argparser.add_argument(
+            '--async_checkpoints', default=False, action='store_true',
+            help='Write weight checkpoints in a background thread'
+        )
+        argparser.add_argument(
+            '--log_interval', type=int, default=DEFAULT_LOG_INTERVAL,
+            help='Log training throughput every this many steps (0 to '
+            'disable)'
+        )
+        argparser.add_argument(
+            '--metrics_file', default=None,
+            help='Also write throughput metrics to file (JSON lines)'
+        )
+        argparser.add_argument(
+            '--profile_start_step', type=int, default=None,
+            help='First training step to trace with the TensorFlow profiler'
+        )
+        argparser.add_argument(
+            '--profile_end_step', type=int, default=None,
+            help='Step after which to stop profiler trace (default '
+            'start+10)'
+        )
+        argparser.add_argument(
+            '--profile_dir', default='profile',
+            help='Directory for profiler traces'
+        )
+        argparser.add_argument(
+            '--read_ahead', type=int, default=0,
+            help='Number of following TSV batches to prepare in background '
+            'threads during the training step'
+        )
+        argparser.add_argument(
+            '--shuffle_tsv', default=False, action='store_true',
+            help='Shuffle TSV and .npy training examples across files '
+            'every epoch'
+        )
+        argparser.add_argument(
+            '--seed', type=int, default=None,
+            help='Random seed for shuffling training data (default random, '
+            'restored with checkpoints)'
+        )
+        argparser.add_argument(
+            '--tsv_pipeline', choices=('sequence', 'tf.data'),
+            default='sequence',
+            help='Read TSV training data with a Keras Sequence or tf.data'
+        )
+        argparser.add_argument(
+            '--tsv_workers', type=int, default=4,
+            help='Number of processes encoding TSV data for tf.data input'
+        )
+        argparser.add_argument(
+            '--tfrecord_cache', default=None,
+            help='Cache TFRecord input in file, or "memory" for in memory'
+        )
+        argparser.add_argument(
+            '--nondeterministic_input', default=False, action='store_true',
+            help='Allow tf.data to return TFRecord examples out of order '
+            'for higher throughput'
+        )
+        argparser.add_argument(
+            '--teacher_model_dir', default=None,
+            help='Train to match the predictions of this trained model '
+            '(knowledge distillation)'
+        )
+        argparser.add_argument(
+            '--student_layers', type=int, default=None,
+            help='Build only this many lower BERT layers (initialized from '
+            'teacher when distilling)'
+        )
+        argparser.add_argument(
+            '--distill_temperature', type=float,
+            default=DEFAULT_DISTILL_TEMPERATURE,
+            help='Softmax temperature for distillation loss'
+        )
+        argparser.add_argument(
+            '--distill_alpha', type=float, default=DEFAULT_DISTILL_ALPHA,
+            help='Weight of distillation loss, 1-alpha for gold labels'
+        )
+        argparser.add_argument(
+            '--soft_labels', default=None,
+            help='Cache teacher probabilities for training data in file '
+            '(.npy)'
+        )
+        argparser.add_argument(
+            '--max_spans', type=int, default=None,
+            help='Classify up to this many candidates per sequence, packing '
+            'candidates with overlapping contexts (NER, TSV input only)'
+        )
+    if mode in ('train', 'predict'):
+        argparser.add_argument(
+            '--bucket_by_length', default=False, action='store_true',
+            help='Batch examples of similar length without trailing padding'
+        )
+    if mode in ('predict', 'serve'):
+        argparser.add_argument(
+            '--prediction_cache_size', type=int, default=0,
+            help='Cache predictions for this many distinct inputs in memory'
+        )
+        argparser.add_argument(
+            '--prediction_cache_file', default=None,
+            help='Also cache predictions in SQLite database file (cleared '
+            'when the model changes)'
+        )
+    if mode == 'predict':
+        argparser.add_argument(
+            '--chunk_size', type=int, default=None,
+            help='Stream input in chunks of this many lines'
+        )
+        argparser.add_argument(
+            '--num_workers', type=int, default=2,
+            help='Number of processes encoding chunks when streaming'
+        )
+        argparser.add_argument(
+            '--output_probs', default=False, action='store_true',
+            help='Output label probabilities after each predicted label'
+        )
+    if mode in ('test', 'predict'):
+        argparser.add_argument(
+            '--probs_output', default=None,
+            help='Write top-k labels and probabilities to file (.npy or .tsv)'
+        )
+        argparser.add_argument(
+            '--top_k', type=int, default=None,
+            help='Number of labels to write to --probs_output (default all)'
+        )
+    if mode in ('test', 'predict', 'serve'):
+        argparser.add_argument(
+            '--output_position_only', default=False, action='store_true',
+            help='Rebuild model to compute its BERT output layer only at '
+            'the classified position'
+        )
+    if mode == 'train':
+        label_field, text_fields = -4, -3
+    else:
+        label_field, text_fields = None, None    # default from model config
     argparser.add_argument(
-        '--label_field', type=int, default=-4,
+        '--label_field', type=int, default=label_field,
         help='Index of label in TSV data (1-based)'
     )
     argparser.add_argument(
-        '--text_fields', type=int, default=-3,
+        '--text_fields', type=int, default=text_fields,
         help='Index of first text field in TSV data (1-based)'
     )
+    argparser.add_argument(
+        '--group_field', type=int, default=0,
+        help='Index of document ID in TSV data for multi-span packing'
+    )
     if mode != 'serve':
         test_data_required = mode in ('test', 'predict',)
         argparser.add_argument(
@@ -144,6 +312,11 @@ def argument_parser(mode):
         '--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
         help='Batch size for training'
     )
+    argparser.add_argument(
+        '--tokenizer_cache_size', type=int,
+        default=DEFAULT_TOKENIZER_CACHE_SIZE,
+        help='Maximum number of cached word tokenizations (0 to disable)'
+    )
     model_dir_required = mode in ('test', 'predict', 'serve')
     argparser.add_argument(
         '--model_dir', default=None, required=model_dir_required,
@@ -151,9 +324,13 @@ def argument_parser(mode):
     )
     if mode == 'serve':
         argparser.add_argument(
-            '--port', default=9000,
+            '--port', type=int, default=9000,
             help='Port to listen to'
         )
+        argparser.add_argument(
+            '--max_wait_ms', type=float, default=5,
+            help='Maximum time to wait for requests to fill a batch'
+        )
     return argparser
 
 
@@ -178,44 +355,475 @@ def delete_old_checkpoints(directory, name, max_checkpoints):
         os.remove(path)
 
 
-class DeleteOldCheckpoints(Callback):
-    def __init__(self, checkpoint_dir, checkpoint_name, max_checkpoints):
+def save_weights_checkpoint(path, weights, optimizer_weights=None):
+    """Write snapshots of model (and optimizer) weights to HDF5 file."""
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['checkpoint_format'] = 'weights'
+        group = f.create_group('model_weights')
+        for i, w in enumerate(weights):
+            group.create_dataset('{:05d}'.format(i), data=w)
+        if optimizer_weights is not None:
+            group = f.create_group('optimizer_weights')
+            for i, w in enumerate(optimizer_weights):
+                group.create_dataset('{:05d}'.format(i), data=w)
+    os.replace(tmp_path, path)
+
+
+def is_weights_checkpoint(path):
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get('checkpoint_format') == 'weights'
+
+
+def load_weights_checkpoint(model, path):
+    """Restore weights saved by save_weights_checkpoint into compiled model."""
+    with h5py.File(path, 'r') as f:
+        if 'optimizer_weights' in f:
+            # Optimizer slots are otherwise only created on the first step.
+            # The update may change the model weights, restored below.
+            create_optimizer_weights(model)
+        group = f['model_weights']
+        model.set_weights([group[k][()] for k in sorted(group)])
+        if 'optimizer_weights' in f:
+            group = f['optimizer_weights']
+            model.optimizer.set_weights([group[k][()] for k in sorted(group)])
+
+
+def create_optimizer_weights(model):
+    """Create optimizer weights by applying zero gradients once."""
+    variables = model.trainable_variables
+
+    def apply_zero_gradients():
+        model.optimizer.apply_gradients(
+            [(tf.zeros_like(v), v) for v in variables])
+    tf.distribute.get_strategy().run(apply_zero_gradients)
+
+
+def checkpoint_state_path(checkpoint_path):
+    return checkpoint_path + '.state.json'
+
+
+def get_rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'numpy': [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+        'python': random.getstate(),
+    }
+
+
+def set_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos,
+                         has_gauss, cached_gaussian))
+    version, internal, gauss_next = state['python']
+    random.setstate((version, tuple(internal), gauss_next))
+
+
+def load_checkpoint_state(checkpoint_path):
+    """Return training state saved with checkpoint, or None if missing."""
+    path = checkpoint_state_path(checkpoint_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class CheckpointSaver(Callback):
+    """Save a checkpoint every save_freq batches, keeping the newest ones.
+
+    The checkpoints are tracked in memory, so the checkpoint directory is
+    listed only once and old checkpoints are deleted only after a save.
+    checkpoint_format is 'model' (full Keras model), 'weights' (model
+    weights only) or 'weights+optimizer'. The weight formats copy the
+    weights when saving and can write them in a background thread
+    (async_save=True) while training continues.
+
+    Each checkpoint has a .state.json sidecar recording the epoch, the
+    global step counted from initial_step, the random number generator
+    state and the values in extra_state, for resuming training.
+    """
+
+    def __init__(self, checkpoint_dir, checkpoint_name, save_freq,
+                 max_checkpoints, checkpoint_format='model', async_save=False,
+                 initial_step=0, extra_state=None):
         self._checkpoint_dir = checkpoint_dir
         self._checkpoint_name = checkpoint_name
+        self._save_freq = save_freq
         self._max_checkpoints = max_checkpoints
-
-    def on_batch_end(self, batch, logs=None):
-        delete_old_checkpoints(
-            self._checkpoint_dir, self._checkpoint_name, self._max_checkpoints)
+        self._format = checkpoint_format
+        if async_save and checkpoint_format == 'model':
+            warning('async checkpoint saving requires a weights format')
+            async_save = False
+        if async_save:
+            self._executor = ThreadPoolExecutor(1)
+        else:
+            self._executor = None
+        self._pending = None
+        # Oldest first
+        self._checkpoints = get_checkpoint_files(checkpoint_dir,
+                                                 checkpoint_name)[::-1]
+        self._epoch = 0
+        self._step = initial_step
+        self._extra_state = extra_state or {}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step += 1
+        if self._step % self._save_freq == 0:
+            self.save(logs)
+
+    def on_train_end(self, logs=None):
+        self._wait()
+
+    def training_state(self):
+        state = {
+            'epoch': self._epoch,
+            'global_step': self._step,
+            'rng': get_rng_state(),
+        }
+        state.update(self._extra_state)
+        return state
+
+    def save(self, logs=None):
+        logs = { k: float(v) for k, v in (logs or {}).items() }
+        path = os.path.join(self._checkpoint_dir, self._checkpoint_name.format(
+            epoch=self._epoch+1, **logs))
+        self._wait()    # at most one checkpoint in memory
+        state = self.training_state()
+        if self._format == 'model':
+            self._write(path, state)
+            return
+        weights = self.model.get_weights()
+        if self._format == 'weights+optimizer':
+            optimizer_weights = self.model.optimizer.get_weights()
+        else:
+            optimizer_weights = None
+        if self._executor is None:
+            self._write(path, state, weights, optimizer_weights)
+        else:
+            self._pending = self._executor.submit(
+                self._write, path, state, weights, optimizer_weights)
+
+    def _wait(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _write(self, path, state, weights=None, optimizer_weights=None):
+        with open(checkpoint_state_path(path), 'w') as out:
+            json.dump(state, out)
+        if weights is None:
+            tmp_path = path + '.tmp'
+            self.model.save(tmp_path, save_format='h5')
+            os.replace(tmp_path, path)
+        else:
+            save_weights_checkpoint(path, weights, optimizer_weights)
+        self._checkpoints = [p for p in self._checkpoints if p != path]
+        self._checkpoints.append(path)
+        self._delete_old()
+
+    def _delete_old(self):
+        delete = self._checkpoints[:-self._max_checkpoints]
+        if not delete:
+            return
+        print('Deleting {}/{} checkpoints: {}'.format(
+            len(delete), len(self._checkpoints), delete), file=sys.stderr,
+              flush=True)
+        for path in delete:
+            for fn in (path, checkpoint_state_path(path)):
+                try:
+                    os.remove(fn)
+                except FileNotFoundError:
+                    pass
+        self._checkpoints = self._checkpoints[-self._max_checkpoints:]
+
+
+def truncate_bert_config(config_file, num_layers, directory):
+    """Write copy of BERT config with only num_layers encoder layers."""
+    with open(config_file) as f:
+        config = json.load(f)
+    if num_layers > config['num_hidden_layers']:
+        raise ValueError('cannot output layer {}, model has {} layers'.format(
+            num_layers, config['num_hidden_layers']))
+    config['num_hidden_layers'] = num_layers
+    path = os.path.join(directory, os.path.basename(config_file))
+    with open(path, 'w') as out:
+        json.dump(config, out, indent=2)
+    return path
 
 
 @timed
-def load_pretrained(options):
-    model = load_trained_model_from_checkpoint(
-        options.bert_config_file,
-        options.init_checkpoint,
-        training=False,
-        trainable=True,
-        seq_len=options.max_seq_length,
-    )
+def load_pretrained(options, num_layers=None):
+    if getattr(options, 'bucket_by_length', False):
+        seq_len = None    # variable-length input
+    else:
+        seq_len = options.max_seq_length
+    layer_index = getattr(options, 'output_layer', '-1')
+    if (num_layers is None and is_signed_digit(layer_index) and
+        int(layer_index) > 0):
+        # Layers above the output cannot affect it, so only build and
+        # load the encoder layers up to it
+        num_layers = int(layer_index)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = options.bert_config_file
+        if num_layers is not None:
+            config_file = truncate_bert_config(config_file, num_layers,
+                                               tmpdir)
+        model = load_trained_model_from_checkpoint(
+            config_file,
+            options.init_checkpoint,
+            training=False,
+            trainable=True,
+            seq_len=seq_len,
+        )
     return model
 
 
 def get_tokenizer(options):
     tokenizer = tokenization.FullTokenizer(
         vocab_file=options.vocab_file,
-        do_lower_case=options.do_lower_case
+        do_lower_case=options.do_lower_case,
+        cache_size=options.tokenizer_cache_size
     )
     return tokenizer
 
 
+class GatherPositions(keras.layers.Layer):
+    """Select the outputs at given positions of each sequence."""
+
+    def call(self, inputs):
+        sequence, positions = inputs
+        return tf.gather(sequence, positions, batch_dims=1)
+
+
+class AccumulatingModel(keras.Model):
+    """Functional model accumulating gradients over micro-batches.
+
+    Each training batch is split into (at most) accumulation_steps
+    non-empty micro-batches whose gradients are summed, weighted by micro-batch size, before a
+    single optimizer update. Only one micro-batch of activations is kept
+    for backpropagation at a time, and the optimizer sees one step per
+    batch. Under a distribution strategy, each replica accumulates its
+    share of the batch and gradients are aggregated once per update.
+    """
+
+    accumulation_steps = 1
+
+    # If set, batches are recorded in input_stats (see InputStats) when
+    # train_step receives them, after any waiting for input
+    input_stats = None
+    input_pad_id = 0
+
+    def train_step(self, data):
+        if self.input_stats is not None:
+            data = record_input(self.input_stats, data, self.input_pad_id)
+        if self.accumulation_steps == 1:
+            return super().train_step(data)
+        if len(data) == 3:
+            x, y, sample_weight = data
+        else:
+            (x, y), sample_weight = data, None
+        num_steps = self.accumulation_steps
+        batch_size = tf.shape(y)[0]
+        micro_size = (batch_size + num_steps - 1) // num_steps
+        # A short (e.g. last) batch may fill fewer than num_steps
+        # micro-batches; skip the empty ones
+        num_steps = (batch_size + micro_size - 1) // micro_size
+        variables = self.trainable_variables
+        gradients = [tf.zeros_like(v) for v in variables]
+        for i in tf.range(num_steps):
+            start = i * micro_size
+            end = tf.minimum(start + micro_size, batch_size)
+            micro = lambda t: t[start:end]
+            micro_x = tf.nest.map_structure(micro, x)
+            micro_y = micro(y)
+            if sample_weight is None:
+                micro_w = None
+            else:
+                micro_w = micro(sample_weight)
+            with tf.GradientTape() as tape:
+                y_pred = self(micro_x, training=True)
+                loss = self.compiled_loss(micro_y, y_pred, micro_w,
+                                          regularization_losses=self.losses)
+            weight = (tf.cast(end - start, tf.float32) /
+                      tf.cast(batch_size, tf.float32))
+            micro_gradients = tape.gradient(loss, variables)
+            gradients = [
+                g if m is None else g + weight * tf.convert_to_tensor(m)
+                for g, m in zip(gradients, micro_gradients)
+            ]
+            self.compiled_metrics.update_state(micro_y, y_pred, micro_w)
+        self.optimizer.apply_gradients(zip(gradients, variables))
+        return { m.name: m.result() for m in self.metrics }
+
+
+class DistillationLoss(keras.losses.Loss):
+    """Temperature-scaled KL divergence from teacher to model predictions.
+
+    Targets are gold labels followed by teacher label probabilities (see
+    pack_distillation_targets). The KL term is scaled by temperature**2
+    and weighted by alpha, with cross-entropy on the gold labels weighted
+    by 1-alpha. Softmax outputs are rescaled as softmax(log(p)/T), which
+    equals softmax(logits/T).
+    """
+
+    def __init__(self, temperature=1.0, alpha=1.0,
+                 name='distillation_loss', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def _log_softmax_t(self, probs):
+        epsilon = keras.backend.epsilon()
+        logits = tf.math.log(tf.clip_by_value(probs, epsilon, 1.0))
+        return tf.nn.log_softmax(logits / self.temperature)
+
+    def call(self, y_true, y_pred):
+        labels, teacher_probs = y_true[:, 0], y_true[:, 1:]
+        teacher_log_probs = self._log_softmax_t(teacher_probs)
+        kl = tf.reduce_sum(
+            tf.exp(teacher_log_probs) *
+            (teacher_log_probs - self._log_softmax_t(y_pred)),
+            axis=-1
+        )
+        loss = self.alpha * self.temperature**2 * kl
+        if self.alpha < 1:
+            loss += (1 - self.alpha) * \
+                keras.losses.sparse_categorical_crossentropy(labels, y_pred)
+        return loss
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(temperature=self.temperature, alpha=self.alpha)
+        return config
+
+
+def distillation_accuracy(y_true, y_pred):
+    return keras.metrics.sparse_categorical_accuracy(y_true[:, :1], y_pred)
+
+
+def pack_distillation_targets(labels, teacher_probs):
+    """Combine gold labels and teacher probabilities for DistillationLoss."""
+    labels = np.asarray(labels, dtype=np.float32).reshape(-1, 1)
+    return np.concatenate(
+        [labels, np.asarray(teacher_probs, dtype=np.float32)], axis=-1)
+
+
+def bert_layer_weights(model):
+    """Return weights of the embedding and encoder layers by layer name."""
+    return {
+        l.name: l.get_weights() for l in model.layers
+        if l.name.startswith(('Embedding-', 'Encoder-')) and l.weights
+    }
+
+
+def set_layer_weights(model, weights):
+    """Set weights of layers by name where shapes match, return count."""
+    count = 0
+    for layer in model.layers:
+        values = weights.get(layer.name)
+        if values is None:
+            continue
+        if [v.shape for v in values] != [tuple(w.shape) for w in layer.weights]:
+            continue
+        layer.set_weights(values)
+        count += 1
+    return count
+
+
+def custom_objects():
+    objects = get_custom_objects()
+    objects['GatherPositions'] = GatherPositions
+    objects['AccumulatingModel'] = AccumulatingModel
+    objects['DistillationLoss'] = DistillationLoss
+    objects['distillation_accuracy'] = distillation_accuracy
+    return objects
+
+
 def get_bert_output(model, layer_index, output_offset):
     if layer_index == -1:
         layer_output = model.output
     else:
         layer_name = 'Encoder-{}-FeedForward-Norm'.format(layer_index)
         layer_output = model.get_layer(layer_name).output
-    return layer_output[:, output_offset]
+    if isinstance(output_offset, int):
+        return layer_output[:, output_offset]
+    else:
+        return GatherPositions()([layer_output, output_offset])
+
+
+def output_position_layer(pretrained_model, layer_index, output_offset):
+    """Compute encoder layer layer_index only at the output positions.
+
+    Attention queries, feed-forward and normalization of the layer are
+    applied at the output positions only, attending over keys and values
+    at all positions. The pretrained layers are reused, so the weights
+    and outputs are the same as for get_bert_output().
+    """
+    prefix = 'Encoder-{}-'.format(layer_index)
+
+    def apply(name, inputs, optional=False):
+        try:
+            layer = pretrained_model.get_layer(prefix + name)
+        except ValueError:
+            if not optional:
+                raise
+            return inputs    # no dropout layers when dropout rate is 0
+        return layer(inputs)
+
+    sequence = pretrained_model.get_layer(
+        prefix + 'MultiHeadSelfAttention').input
+    if isinstance(output_offset, int):
+        query = sequence[:, output_offset:output_offset+1]
+    else:
+        query = GatherPositions()([sequence, output_offset])
+    output = apply('MultiHeadSelfAttention', [query, sequence, sequence])
+    output = apply('MultiHeadSelfAttention-Dropout', output, optional=True)
+    output = apply('MultiHeadSelfAttention-Add', [query, output])
+    attention_output = apply('MultiHeadSelfAttention-Norm', output)
+    output = apply('FeedForward', attention_output)
+    output = apply('FeedForward-Dropout', output, optional=True)
+    output = apply('FeedForward-Add', [attention_output, output])
+    output = apply('FeedForward-Norm', output)
+    if isinstance(output_offset, int):
+        return output[:, 0]
+    else:
+        return output
+
+
+def position_only_model(model, config):
+    """Return trained model rebuilt to compute its output encoder layer
+    only at the classified positions (see output_position_layer()).
+
+    The rebuilt model shares the layers and weights of model. Returns
+    model unchanged if it was trained with output_position_only.
+    """
+    if config.get('output_position_only'):
+        return model
+    layer_index = config.get('output_layer', '-1')
+    if not is_signed_digit(layer_index):
+        raise ValueError('output position only computation requires '
+                         'integer output layer, model has {}'.format(
+                             layer_index))
+    layer_index = int(layer_index)
+    if layer_index == -1:
+        layer_index = num_encoder_layers(model)
+    if config.get('max_spans'):
+        output_offset = model.get_layer('Input-Positions').output
+    else:
+        output_offset = int(config['max_seq_length']/2)
+    output = output_position_layer(model, layer_index, output_offset)
+    output = model.get_layer(model.output_names[0])(output)
+    return model.__class__(inputs=model.inputs, outputs=output)
+
+
+def num_encoder_layers(model):
+    return sum(
+        1 for l in model.layers
+        if re.match(r'^Encoder-\d+-FeedForward-Norm$', l.name)
+    )
 
 
 def is_signed_digit(s):
@@ -228,9 +836,24 @@ def is_signed_digit(s):
 
 
 def create_model(pretrained_model, num_labels, output_offset,
-                 layer_index):
+                 layer_index, max_spans=None, accumulation_steps=1,
+                 output_position_only=False):
     model_inputs = pretrained_model.inputs[:2]
-    if is_signed_digit(layer_index):
+    if max_spans:
+        # Classify the spans at the given positions instead of the center
+        output_offset = keras.layers.Input(
+            shape=(max_spans,), dtype='int32', name='Input-Positions')
+        model_inputs.append(output_offset)
+    if output_position_only:
+        if not is_signed_digit(layer_index):
+            raise ValueError('output position only computation requires '
+                             'integer output layer')
+        layer_index = int(layer_index)
+        if layer_index == -1:
+            layer_index = num_encoder_layers(pretrained_model)
+        pretrained_output = output_position_layer(pretrained_model,
+                                                  layer_index, output_offset)
+    elif is_signed_digit(layer_index):
         layer_index = int(layer_index)
         pretrained_output = get_bert_output(pretrained_model, layer_index,
                                             output_offset)
@@ -252,7 +875,8 @@ def create_model(pretrained_model, num_labels, output_offset,
         num_labels,
         activation='softmax'
     )(pretrained_output)
-    model = keras.models.Model(inputs=model_inputs, outputs=model_output)
+    model = AccumulatingModel(inputs=model_inputs, outputs=model_output)
+    model.accumulation_steps = accumulation_steps
     return model
 
 
@@ -260,6 +884,10 @@ def _model_path(model_dir):
     return os.path.join(model_dir, 'model.hdf5')
 
 
+def _tflite_path(model_dir):
+    return os.path.join(model_dir, 'model.tflite')
+
+
 def _vocab_path(model_dir):
     return os.path.join(model_dir, 'vocab.txt')
 
@@ -272,6 +900,17 @@ def _config_path(model_dir):
     return os.path.join(model_dir, 'config.json')
 
 
+# Encoding options saved with the model and their values for models
+# saved before they were recorded
+MODEL_CONFIG_DEFAULTS = {
+    'task_name': 'NER',
+    'replace_span_A': None,
+    'replace_span_B': None,
+    'label_field': -4,
+    'text_fields': -3,
+}
+
+
 def save_model_etc(model, tokenizer, labels, options):
     # TODO rename
     os.makedirs(options.model_dir, exist_ok=True)
@@ -279,7 +918,16 @@ def save_model_etc(model, tokenizer, labels, options):
         'do_lower_case': options.do_lower_case,
         'max_seq_length': options.max_seq_length,
         'replace_span': options.replace_span,
+        'max_spans': getattr(options, 'max_spans', None),
+        'output_layer': options.output_layer,
+        'output_position_only': getattr(options, 'output_position_only',
+                                        False),
+        # Encoder layers in the saved model, fewer than in the pretrained
+        # model when classifying from an intermediate layer
+        'encoder_layers': num_encoder_layers(model),
     }
+    for key in MODEL_CONFIG_DEFAULTS:
+        config[key] = getattr(options, key)
     with open(_config_path(options.model_dir), 'w') as out:
         json.dump(config, out, indent=4)
     model.save(_model_path(options.model_dir))
@@ -294,18 +942,133 @@ def save_model_etc(model, tokenizer, labels, options):
 def load_model(model_path):
     return keras.models.load_model(
         model_path,
-        custom_objects=get_custom_objects()
+        custom_objects=custom_objects()
     )
 
 
-def load_model_etc(model_dir):
+def _tflite_input_name(tensor_name):
+    # Converted Keras inputs are named e.g. serving_default_Input-Token:0,
+    # or Input-Token by older converters
+    name = re.sub(r':\d+$', '', tensor_name)
+    if name.startswith('serving_default_'):
+        name = name[len('serving_default_'):]
+    return name
+
+
+class TFLiteModel:
+    """TFLite model with the prediction methods of a Keras model.
+
+    Inputs are matched to the interpreter by the input names of the
+    exported Keras model, and resized to the shape of each batch.
+    """
+
+    def __init__(self, path, input_names=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path)
+        details = self.interpreter.get_input_details()
+        if input_names is not None:
+            by_name = {}
+            for d in details:
+                name = _tflite_input_name(d['name'])
+                if name in by_name:
+                    raise ValueError('duplicate input {} in {}'.format(
+                        name, path))
+                by_name[name] = d
+            missing = [n for n in input_names if n not in by_name]
+            if missing:
+                raise ValueError('input(s) {} not found in {} (has {})'.format(
+                    ', '.join(missing), path, ', '.join(sorted(by_name))))
+            details = [by_name[name] for name in input_names]
+        self._inputs = details
+        self._output = self.interpreter.get_output_details()[0]
+        self._shapes = None
+        self._lock = threading.Lock()
+
+    @property
+    def variable_length(self):
+        shape = self._inputs[0].get('shape_signature',
+                                    self._inputs[0]['shape'])
+        return shape[1] == -1
+
+    def predict_on_batch(self, x):
+        x = [np.asarray(v) for v in x]
+        shapes = [v.shape for v in x]
+        with self._lock:
+            if shapes != self._shapes:
+                for detail, shape in zip(self._inputs, shapes):
+                    self.interpreter.resize_tensor_input(detail['index'],
+                                                         shape)
+                self.interpreter.allocate_tensors()
+                self._shapes = shapes
+            for detail, values in zip(self._inputs, x):
+                self.interpreter.set_tensor(detail['index'],
+                                            values.astype(detail['dtype']))
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output['index'])
+
+    def predict(self, x, batch_size=None, **kwargs):
+        if isinstance(x, tf.data.Dataset):
+            # Batched (inputs, labels) as from load_tfrecords()
+            batches = (inputs for inputs, _ in x.as_numpy_iterator())
+        else:
+            batch_size = batch_size or DEFAULT_BATCH_SIZE
+            batches = (
+                [v[i:i+batch_size] for v in x]
+                for i in range(0, len(x[0]), batch_size)
+            )
+        probs = [self.predict_on_batch(batch) for batch in batches]
+        if not probs:
+            return np.zeros((0, self._output['shape'][-1]), dtype=np.float32)
+        return np.concatenate(probs)
+
+
+def save_tflite_model_etc(tflite_model, model_dir, output_dir, config):
+    """Save converted model with the tokenizer and labels of model_dir."""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(_tflite_path(output_dir), 'wb') as out:
+        out.write(tflite_model)
+    with open(_config_path(output_dir), 'w') as out:
+        json.dump(config, out, indent=4)
+    shutil.copy(_vocab_path(model_dir), _vocab_path(output_dir))
+    shutil.copy(_labels_path(model_dir), _labels_path(output_dir))
+
+
+def load_model_config(model_dir):
     with open(_config_path(model_dir)) as f:
-        config = json.load(f)
-    model = load_model(_model_path(model_dir))
+        return json.load(f)
+
+
+def apply_model_config(options, config):
+    """Set encoding options not given on the command line from config."""
+    options.max_seq_length = config['max_seq_length']
+    options.replace_span = config['replace_span']
+    for key, default in MODEL_CONFIG_DEFAULTS.items():
+        if getattr(options, key, None) is None:
+            setattr(options, key, config.get(key, default))
+
+
+def load_model_tokenizer(model_dir, config,
+                         cache_size=DEFAULT_TOKENIZER_CACHE_SIZE):
     tokenizer = tokenization.FullTokenizer(
         vocab_file=_vocab_path(model_dir),
-        do_lower_case=config['do_lower_case']
+        do_lower_case=config['do_lower_case'],
+        cache_size=cache_size
     )
+    return tokenizer
+
+
+def load_model_etc(model_dir, cache_size=DEFAULT_TOKENIZER_CACHE_SIZE,
+                   output_position_only=False):
+    config = load_model_config(model_dir)
+    if os.path.exists(_tflite_path(model_dir)):
+        if output_position_only:
+            warning('ignoring --output_position_only for TFLite model')
+        model = TFLiteModel(_tflite_path(model_dir),
+                            config.get('input_names'))
+    else:
+        model = load_model(_model_path(model_dir))
+        if output_position_only:
+            model = position_only_model(model, config)
+    tokenizer = load_model_tokenizer(model_dir, config, cache_size)
     labels = load_labels(_labels_path(model_dir))
     return model, tokenizer, labels, config
 
@@ -355,9 +1118,9 @@ def tokenize_texts_re(texts, tokenizer):
     tokenized = []
     for sent_start, entity1, text_between_ent_1_and_ent_2, entity2, sent_end in texts:
         sent_start_tok = fix_unused_tokens(tokenizer.tokenize(sent_start))
-        entity1_tok = fix_unused_tokens(tokenizer.tokenize(entity1))
+        entity1_tok = fix_unused_tokens(tokenizer.tokenize_text(entity1))
         text_between_ent_1_and_ent_2_tok = fix_unused_tokens(tokenizer.tokenize(text_between_ent_1_and_ent_2))
-        entity2_tok = fix_unused_tokens(tokenizer.tokenize(entity2))
+        entity2_tok = fix_unused_tokens(tokenizer.tokenize_text(entity2))
         sent_end_tok = fix_unused_tokens(tokenizer.tokenize(sent_end))
         tokenized.append([sent_start_tok, entity1_tok, text_between_ent_1_and_ent_2_tok, entity2_tok, sent_end_tok])
     return tokenized
@@ -366,51 +1129,67 @@ def tokenize_texts(texts, tokenizer):
     tokenized = []
     for left, span, right in texts:
         left_tok = tokenizer.tokenize(left)
-        span_tok = tokenizer.tokenize(span)
+        span_tok = tokenizer.tokenize_text(span)
         right_tok = tokenizer.tokenize(right)
         tokenized.append([left_tok, span_tok, right_tok])
     return tokenized
 
+def encode_token_rows(rows, tokenizer, seq_len, dtype=np.int32):
+    """Encode (num_pad, tokens) rows into token and segment ID matrices.
+
+    Each row becomes [CLS], num_pad [PAD]s, tokens and [SEP], truncated
+    to and then padded to seq_len. The matrices are preallocated and
+    filled by slicing, so padding is never converted token by token.
+    """
+    vocab = tokenizer.vocab
+    cls_id, sep_id, pad_id = vocab['[CLS]'], vocab['[SEP]'], vocab['[PAD]']
+    token_ids = np.full((len(rows), seq_len), pad_id, dtype=dtype)
+    token_ids[:, 0] = cls_id
+    max_end = seq_len-1    # last position reserved for [SEP]
+    for i, (num_pad, tokens) in enumerate(rows):
+        start = 1 + num_pad
+        end = min(start + len(tokens), max_end)
+        if end > start:
+            ids = tokenizer.convert_tokens_to_ids(tokens[:end-start])
+            token_ids[i, start:end] = ids
+        token_ids[i, end] = sep_id
+    segment_ids = np.zeros((len(rows), seq_len), dtype=dtype)
+    return token_ids, segment_ids
+
+
 def encode_tokenized(tokenized_texts, tokenizer, seq_len, replace_span):
-    tids, sids = [], []
+    rows = []
+    center = int(seq_len/2)
+    max_left = center-1    # -1 for CLS
     for left, span, right in tokenized_texts:
-        tokens = ['[CLS]']
-        center = int(seq_len/2)
-        if len(left) > center-1:    # -1 for CLS
-            left = left[len(left)-(center-1):]
-        else:
-            left = ['[PAD]'] * ((center-1)-len(left)) + left
-        tokens.extend(left)
+        left = left[max(0, len(left)-max_left):]
+        num_pad = max_left-len(left)
         if not replace_span:
-            tokens.extend(span)
+            tokens = left + span + right
         else:
-            tokens.append(replace_span)
-        tokens.extend(right)
-        if len(tokens) >= seq_len-1:    # -1 for [SEP]
-            tokens, chopped = tokens[:seq_len-1], tokens[seq_len-1:]
+            tokens = left + [replace_span] + right
+        if 1 + num_pad + len(tokens) >= seq_len-1:    # -1 for [SEP]
+            kept = seq_len-2-num_pad
             info('chopping tokens to {}: {} ///// {}'.format(
-                seq_len-1, ' '.join(tokens), ' '.join(chopped)))
-        tokens.append('[SEP]')
-        tokens.extend(['[PAD]'] * (seq_len-len(tokens)))
-        token_ids = tokenizer.convert_tokens_to_ids(tokens)
-        segment_ids = [0] * seq_len
-        tids.append(token_ids)
-        sids.append(segment_ids)
-    # Sanity check
-    assert all(len(t) == seq_len for t in tids)
-    assert all(len(s) == seq_len for s in sids)
-    return np.array(tids), np.array(sids)
+                seq_len-1,
+                ' '.join(['[CLS]'] + ['[PAD]'] * num_pad + tokens[:kept]),
+                ' '.join(tokens[kept:])))
+        rows.append((num_pad, tokens))
+    return encode_token_rows(rows, tokenizer, seq_len)
 
 def encode_tokenized_re(tokenized_texts, tokenizer, seq_len, replace_span_A, replace_span_B):
-    tids, sids = [], []
+    rows = []
+    center = int(seq_len/2)
     for sent_start_tok, entity1_tok, text_between_ent_1_and_ent_2_tok, entity2_tok, sent_end_tok in tokenized_texts:
-        tokens = ['[CLS]']
-        center = int(seq_len/2)
-        if (len(sent_start_tok+entity1_tok)+int(round(len(text_between_ent_1_and_ent_2_tok)/2))) > center-1:
-            sent_start_tok = sent_start_tok[len(sent_start_tok+entity1_tok)+int(round(len(text_between_ent_1_and_ent_2_tok)/2))-(center-1):]
+        # Place the midpoint between the two entities at the center
+        half_between = int(round(len(text_between_ent_1_and_ent_2_tok)/2))
+        before_center = len(sent_start_tok+entity1_tok)+half_between
+        if before_center > center-1:
+            sent_start_tok = sent_start_tok[before_center-(center-1):]
+            num_pad = 0
         else:
-            sent_start_tok = ['[PAD]'] * ((center-1)-len(sent_start_tok+entity1_tok)+int(round(len(text_between_ent_1_and_ent_2_tok)/2))) + sent_start_tok
-        tokens.extend(sent_start_tok)
+            num_pad = max(0, (center-1)-len(sent_start_tok+entity1_tok)+half_between)
+        tokens = list(sent_start_tok)
 
         if not replace_span_A:
             tokens.extend(entity1_tok)
@@ -423,28 +1202,51 @@ def encode_tokenized_re(tokenized_texts, tokenizer, seq_len, replace_span_A, rep
         else:
             tokens.append(replace_span_B)
         tokens.extend(sent_end_tok)
-
-        if len(tokens) >= seq_len -1:
-            tokens, chopped = tokens[:seq_len-1], tokens[seq_len-1:]
-            #shows the chopped inputs, log files for 10M end up being 3gb because of that so I stopped logging that
-            #print('chopping tokens to {}: {} ///// {}'.format(seq_len-1, ' '.join(tokens), ' '.join(chopped)))
-        tokens.append('[SEP]')
-        tokens.extend(['[PAD]'] * (seq_len-len(tokens)))
-        segment_ids = []
-        token_ids = tokenizer.convert_tokens_to_ids(tokens)
-        input_mask = []
-        for token in tokens:
-            if token == "[PAD]":
-                input_mask.append(0)
-            else:
-                input_mask.append(1)
-        segment_ids = [0] * seq_len
-        tids.append(token_ids)
-        sids.append(segment_ids)
-    # Sanity check
-    assert all(len(t) == seq_len for t in tids)
-    assert all(len(s) == seq_len for s in sids)
-    return np.array(tids), np.array(sids)
+        #chopped inputs are not logged, log files for 10M end up being 3gb because of that
+        rows.append((num_pad, tokens))
+    return encode_token_rows(rows, tokenizer, seq_len)
+
+
+def encoded_lengths(token_ids, pad_id=0):
+    """Return lengths of token_ids rows without trailing padding."""
+    nonpad = token_ids != pad_id
+    return token_ids.shape[1] - np.argmax(nonpad[:, ::-1], axis=1)
+
+
+def trim_padding(x, min_len=0, pad_id=0):
+    """Cut trailing padding columns shared by all rows of a batch."""
+    token_ids, segment_ids = x
+    length = max(encoded_lengths(token_ids, pad_id).max(), min_len)
+    return token_ids[:, :length], segment_ids[:, :length]
+
+
+def has_variable_length_input(model):
+    if isinstance(model, TFLiteModel):
+        return model.variable_length
+    return model.inputs[0].shape[1] is None
+
+
+def predict_bucketed(model, x, batch_size, pad_id=0, out=sys.stderr):
+    """Predict in batches of similar length, returning probs in input order."""
+    token_ids, segment_ids = x
+    lengths = encoded_lengths(token_ids, pad_id)
+    order = np.argsort(lengths, kind='stable')
+    probs, computed = None, 0
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start+batch_size]
+        length = lengths[idx].max()
+        batch_probs = np.asarray(model.predict_on_batch(
+            [token_ids[idx, :length], segment_ids[idx, :length]]))
+        if probs is None:
+            probs = np.zeros((len(order), batch_probs.shape[-1]),
+                             dtype=batch_probs.dtype)
+        probs[idx] = batch_probs
+        computed += len(idx) * length
+    if computed:
+        tokens = np.count_nonzero(token_ids != pad_id)
+        print('Token utilization: {:.1%} padded, {:.1%} bucketed'.format(
+            tokens/token_ids.size, tokens/computed), file=out, flush=True)
+    return probs
 
 
 def positive_index(i, fields):
@@ -478,19 +1280,225 @@ def load_tsv_data(fn, options):
     return labels, texts
 
 
-def encode_data(texts, labels, tokenizer, max_seq_len, label_map,
-                options):
+def encode_texts(texts, tokenizer, max_seq_len, options):
     if options.task_name == "NER":
         tokenized = tokenize_texts(texts, tokenizer)
         x = encode_tokenized(tokenized, tokenizer, max_seq_len, options.replace_span)
-        y = np.array([label_map[l] for l in labels])
     else:
         tokenized = tokenize_texts_re(texts, tokenizer)
         x = encode_tokenized_re(tokenized, tokenizer, max_seq_len, options.replace_span_A, options.replace_span_B)
-        y = np.array([label_map[l] for l in labels])        
+    return x
+
+
+def encode_data(texts, labels, tokenizer, max_seq_len, label_map,
+                options):
+    x = encode_texts(texts, tokenizer, max_seq_len, options)
+    y = np.array([label_map[l] for l in labels])
     return x, y
 
 
+def model_fingerprint(model_dir):
+    """Return hash of the saved model and its config."""
+    digest = hashlib.sha1()
+    for path in (_model_path(model_dir), _tflite_path(model_dir),
+                 _config_path(model_dir)):
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    """Cache of model predictions keyed on a hash of the encoded inputs.
+
+    Predictions are kept for up to max_size inputs in memory (least
+    recently used dropped first) and, if path is given, for all inputs in
+    an SQLite database. The database is cleared if it was written for a
+    model with a different fingerprint (see model_fingerprint).
+    """
+
+    def __init__(self, fingerprint, max_size, path=None):
+        self.max_size = max_size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.batch_duplicates = 0
+        self.computed = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if path is None:
+            self._db = None
+        else:
+            self._db = self._open_db(path, fingerprint)
+
+    @staticmethod
+    def _open_db(path, fingerprint):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute('CREATE TABLE IF NOT EXISTS meta '
+                   '(key TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                   '(key BLOB PRIMARY KEY, shape TEXT, probs BLOB)')
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            if row is not None:
+                print('Model changed, clearing prediction cache {}'.format(
+                    path), file=sys.stderr, flush=True)
+            db.execute('DELETE FROM predictions')
+            db.execute("INSERT OR REPLACE INTO meta VALUES "
+                       "('fingerprint', ?)", (fingerprint,))
+        db.commit()
+        return db
+
+    @staticmethod
+    def keys(x):
+        """Return hashes of the rows of all model inputs."""
+        rows = np.concatenate([
+            np.asarray(v, dtype=np.int32).reshape(len(v), -1) for v in x
+        ], axis=1)
+        return [hashlib.sha1(row.tobytes()).digest() for row in rows]
+
+    def _get(self, key):
+        probs = self._memory.get(key)
+        if probs is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return probs
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            'SELECT shape, probs FROM predictions WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        shape = tuple(int(d) for d in row[0].split(',') if d)
+        probs = np.frombuffer(row[1], dtype=np.float32).reshape(shape)
+        self._remember(key, probs)
+        self.disk_hits += 1
+        return probs
+
+    def _remember(self, key, probs):
+        if self.max_size:
+            self._memory[key] = probs
+            if len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _put(self, keys, probs):
+        probs = np.asarray(probs, dtype=np.float32)
+        for key, p in zip(keys, probs):
+            self._remember(key, p)
+        if self._db is not None:
+            shape = ','.join(str(d) for d in probs.shape[1:])
+            self._db.executemany(
+                'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                ((k, shape, p.tobytes()) for k, p in zip(keys, probs)))
+            self._db.commit()
+
+    def predict(self, predict_fn, x):
+        """Return predict_fn(x), computing only rows not in the cache.
+
+        Identical rows in x are computed once.
+        """
+        if len(x[0]) == 0:
+            return predict_fn(x)
+        keys = self.keys(x)
+        results = [None] * len(keys)
+        missing = OrderedDict()    # key to index of first row
+        with self._lock:
+            for i, key in enumerate(keys):
+                results[i] = self._get(key)
+                if results[i] is not None:
+                    continue
+                elif key in missing:
+                    self.batch_duplicates += 1
+                else:
+                    missing[key] = i
+        if missing:
+            index = np.array(list(missing.values()))
+            probs = np.asarray(predict_fn([np.asarray(v)[index] for v in x]))
+            computed = dict(zip(missing, probs))
+            with self._lock:
+                self._put(list(missing), probs)
+                self.computed += len(missing)
+            for i, key in enumerate(keys):
+                if results[i] is None:
+                    results[i] = computed[key]
+        return np.stack(results)
+
+    def stats(self):
+        total = (self.memory_hits + self.disk_hits + self.batch_duplicates +
+                 self.computed)
+        return {
+            'hit_rate': 1 - self.computed/total if total else 0.0,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'batch_duplicates': self.batch_duplicates,
+            'computed': self.computed,
+            'memory_size': len(self._memory),
+        }
+
+    def __str__(self):
+        return ('{hit_rate:.1%} hit rate ({memory_hits} memory, {disk_hits} '
+                'disk, {batch_duplicates} in-batch duplicates, {computed} '
+                'computed)'.format(**self.stats()))
+
+
+def create_prediction_cache(model_dir, options):
+    """Return PredictionCache configured by options, None if disabled."""
+    if (not options.prediction_cache_size and
+        options.prediction_cache_file is None):
+        return None
+    fingerprint = model_fingerprint(model_dir)
+    return PredictionCache(fingerprint, options.prediction_cache_size,
+                           options.prediction_cache_file)
+
+
+class TopKWriter(object):
+    """Write the k most probable labels of each example with probabilities.
+
+    Output is TSV (label, probability pairs) or, for paths ending in .npy,
+    a structured array with fields 'label' (label indices) and 'prob'.
+    """
+
+    def __init__(self, path, labels, k=None, num_examples=None):
+        self.labels = labels
+        self.k = min(k or len(labels), len(labels))
+        self.count = 0
+        if path.endswith('.npy'):
+            if num_examples is None:
+                raise ValueError('number of examples needed for .npy output')
+            dtype = np.dtype([('label', np.uint16, (self.k,)),
+                              ('prob', np.float32, (self.k,))])
+            self._array = np.lib.format.open_memmap(
+                path, mode='w+', dtype=dtype, shape=(num_examples,))
+            self._out = None
+        else:
+            self._array = None
+            self._out = open(path, 'w')
+
+    def write(self, probs):
+        top = np.argsort(-probs, axis=-1, kind='stable')[:, :self.k]
+        top_probs = np.take_along_axis(probs, top, axis=-1)
+        if self._array is not None:
+            rows = slice(self.count, self.count+len(probs))
+            self._array['label'][rows] = top
+            self._array['prob'][rows] = top_probs
+        else:
+            for indices, values in zip(top, top_probs):
+                print('\t'.join('{}\t{:.6f}'.format(self.labels[i], v)
+                                for i, v in zip(indices, values)),
+                      file=self._out)
+        self.count += len(probs)
+
+    def close(self):
+        if self._array is not None:
+            self._array.flush()
+            del self._array
+        else:
+            self._out.close()
+
+
 @timed
 def load_dataset(fn, tokenizer, max_seq_len, label_map, options):
     labels, texts = load_tsv_data(fn, options)
@@ -498,15 +1506,406 @@ def load_dataset(fn, tokenizer, max_seq_len, label_map, options):
                        label_map, options)
 
 
-@timed
-def load_batch_offsets(fn, batch_size):
+def _manifest_path(data_path):
+    return data_path + '.manifest.json'
+
+
+def _offsets_path(data_path):
+    # Not .npy, so that e.g. train*.npy does not match it
+    return data_path + '.offsets'
+
+
+def file_checksum(fn, block_size=2**20):
+    """Checksum of the full contents of file."""
+    digest = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def encoding_config(options):
+    """Return parameters that determine the encoding of the examples."""
+    return {
+        'task_name': options.task_name,
+        'max_seq_length': options.max_seq_length,
+        'do_lower_case': options.do_lower_case,
+        'replace_span': options.replace_span,
+        'replace_span_A': options.replace_span_A,
+        'replace_span_B': options.replace_span_B,
+        'label_field': options.label_field,
+        'text_fields': options.text_fields,
+        'vocab_checksum': file_checksum(options.vocab_file),
+        'labels': load_labels(options.labels),
+    }
+
+
+# Encoding parameters that must match between pre-encoded data and training
+ENCODING_CHECK_KEYS = (
+    'max_seq_length', 'do_lower_case', 'replace_span', 'replace_span_A',
+    'replace_span_B', 'vocab_checksum', 'labels',
+)
+
+
+def check_data_encoding(data_paths, options):
+    """Raise ValueError if pre-encoded data in data_paths was encoded with
+    parameters differing from options, as recorded in its manifest."""
+    current = None
+    for path in data_paths:
+        if path.endswith('.tsv'):
+            continue
+        manifest = load_manifest(path)
+        if manifest is None or manifest.get('encoding') is None:
+            warning('no encoding parameters for {}, not checked'.format(path))
+            continue
+        if current is None:
+            current = encoding_config(options)
+        encoding = manifest['encoding']
+        for key in ENCODING_CHECK_KEYS:
+            if key in encoding and encoding[key] != current[key]:
+                raise ValueError(
+                    '{} encoded with {} {}, differs from current {}'.format(
+                        path, key, encoding[key], current[key]))
+
+
+def write_manifest(data_path, num_examples, encoding=None, line_offsets=None):
+    """Write sidecar manifest recording the number of examples in data_path.
+
+    If given, line_offsets (byte offset of each line start) are saved
+    alongside the manifest for batch and record lookup without scanning.
+    """
+    size, mtime_ns = _file_stamp(data_path)
+    manifest = {
+        'num_examples': num_examples,
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'checksum': file_checksum(data_path),
+        'encoding': encoding,
+    }
+    if line_offsets is not None:
+        assert len(line_offsets) == num_examples
+        with open(_offsets_path(data_path), 'wb') as out:
+            np.save(out, np.asarray(line_offsets, np.int64))
+        manifest['line_offsets'] = os.path.basename(_offsets_path(data_path))
+    with open(_manifest_path(data_path), 'w') as out:
+        json.dump(manifest, out, indent=4)
+
+
+def _file_stamp(fn):
+    stat = os.stat(fn)
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Manifests checked in this process, by data path
+_manifest_cache = {}
+
+
+def load_manifest(data_path):
+    """Return manifest for data_path, or None if missing or out of date.
+
+    The manifest is out of date if the size or modification time of
+    data_path differ from those recorded; see verify_manifest() for a
+    check of the full contents.
+    """
+    path = _manifest_path(data_path)
+    if not os.path.exists(path):
+        return None
+    stamps = (_file_stamp(data_path), _file_stamp(path))
+    cached = _manifest_cache.get(data_path)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+    with open(path) as f:
+        manifest = json.load(f)
+    if [manifest['size'], manifest.get('mtime_ns')] != list(stamps[0]):
+        warning('ignoring out of date manifest {}'.format(path))
+        manifest = None
+    _manifest_cache[data_path] = (stamps, manifest)
+    return manifest
+
+
+def verify_manifest(data_path):
+    """Return True if the full contents of data_path match the checksum
+    recorded in its manifest, False if not or if there is no manifest."""
+    path = _manifest_path(data_path)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        manifest = json.load(f)
+    return manifest.get('checksum') == file_checksum(data_path)
+
+
+def load_line_offsets(data_path):
+    """Return byte offsets of lines in data_path from its manifest, or None."""
+    manifest = load_manifest(data_path)
+    if manifest is None or manifest.get('line_offsets') is None:
+        return None
+    if not os.path.exists(_offsets_path(data_path)):
+        return None    # indexed with an earlier version
+    return np.load(_offsets_path(data_path), mmap_mode='r')
+
+
+def scan_line_offsets(fn):
     offsets, offset = [], 0
     with open(fn, 'rb') as f:
-        for ln, l in enumerate(f):
-            if ln % batch_size == 0:
-                offsets.append(offset)
+        for l in f:
+            offsets.append(offset)
             offset += len(l)
-    return offsets, ln
+    return offsets
+
+
+@timed
+def load_line_index(fn):
+    """Return line start offsets in fn followed by the file size."""
+    line_offsets = load_line_offsets(fn)
+    if line_offsets is None:
+        line_offsets = scan_line_offsets(fn)
+    return np.append(line_offsets, os.path.getsize(fn)).astype(np.int64)
+
+
+@timed
+def load_batch_offsets(fn, batch_size):
+    line_offsets = load_line_offsets(fn)
+    if line_offsets is None:
+        line_offsets = scan_line_offsets(fn)
+    offsets = [int(o) for o in line_offsets[::batch_size]]
+    return offsets, len(line_offsets)
+
+
+class NpySequence(Sequence):
+    """Batches of examples read from memory-mapped .npy data files.
+
+    With shuffle=True, examples are read in an order reshuffled for
+    every epoch, otherwise batches of consecutive examples are read in
+    shuffled order. The order depends only on seed and epoch.
+    """
+
+    def __init__(self, data_paths, batch_size, options, shuffle=False,
+                 seed=None):
+        if isinstance(data_paths, str):
+            data_paths = [data_paths]
+        self._data = [load_npy_data(fn) for fn in data_paths]
+        for fn, (token_ids, _, _) in zip(data_paths, self._data):
+            check_npy_seq_len(token_ids, options.max_seq_length, fn)
+        self._file_starts = np.cumsum([0] + [len(d[0]) for d in self._data])
+        self._batch_size = batch_size
+        if getattr(options, 'bucket_by_length', False):
+            self._min_len = int(options.max_seq_length/2) + 1
+        else:
+            self._min_len = None
+        self.num_examples = int(self._file_starts[-1])
+        self._order = np.arange(self.num_examples)
+        self._shuffle = shuffle
+        self._seed = seed if seed is not None else np.random.randint(2**31)
+        self.set_epoch(0)
+
+    def __len__(self):
+        return int(np.ceil(self.num_examples / self._batch_size))
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+        rng = np.random.RandomState(self._seed + epoch)
+        if self._shuffle:
+            self._order = rng.permutation(self.num_examples)
+        else:
+            self._batch_order = rng.permutation(len(self))
+
+    def __getitem__(self, idx):
+        if not self._shuffle:
+            idx = self._batch_order[idx]
+        examples = self._order[idx*self._batch_size:(idx+1)*self._batch_size]
+        file_indices = np.searchsorted(self._file_starts, examples, 'right')-1
+        token_ids, labels, lengths = [], [], []
+        for f in np.unique(file_indices):
+            # Order within a batch is irrelevant, read rows sequentially
+            rows = np.sort(examples[file_indices == f] - self._file_starts[f])
+            if not self._shuffle:
+                rows = slice(rows[0], rows[-1]+1)
+            t, y, l = self._data[f]
+            token_ids.append(t[rows])
+            labels.append(y[rows])
+            if self._min_len is not None:
+                lengths.append(l[rows] if l is not None else
+                               encoded_lengths(t[rows]))
+        token_ids = np.concatenate(token_ids)
+        labels = np.concatenate(labels)
+        if self._min_len is None:
+            length = None
+        else:
+            length = max(np.concatenate(lengths).max(), self._min_len)
+        return npy_inputs(token_ids, length), labels.astype(np.int32)
+
+    def on_epoch_end(self):
+        self.set_epoch(self._epoch + 1)
+
+
+class OffsetSequence(Sequence):
+    """View of a Sequence from batch start on, for resuming an epoch."""
+
+    def __init__(self, sequence, start):
+        self.sequence = sequence
+        self.start = start
+
+    def __len__(self):
+        return len(self.sequence) - self.start
+
+    def __getitem__(self, idx):
+        return self.sequence[self.start + idx]
+
+    def set_epoch(self, epoch):
+        self.sequence.set_epoch(epoch)
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+
+def host_memory_mb():
+    """Return resident set size of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        # Peak rather than current size, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class InputStats(object):
+    """Examples and non-padding tokens in batches received by training
+    steps, and the times at which the steps received them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.examples = 0
+        self.tokens = 0
+        self._received = deque()
+
+    def record(self, examples, tokens):
+        with self._lock:
+            self.examples += int(examples)
+            self.tokens += int(tokens)
+            self._received.append(time())
+        return np.int64(0)
+
+    def first_received(self, start, end):
+        """Return first time in [start, end] a batch was received, or
+        None."""
+        with self._lock:
+            while self._received and self._received[0] < start:
+                self._received.popleft()
+            if self._received and self._received[0] <= end:
+                return self._received.popleft()
+            return None
+
+
+def record_input(stats, data, pad_id=0):
+    """Return data, recording its batch in stats when it is computed."""
+    token_ids = tf.nest.flatten(data[0])[0]
+    tokens = tf.math.count_nonzero(tf.not_equal(token_ids, pad_id))
+    done = tf.numpy_function(stats.record,
+                             [tf.shape(token_ids)[0], tokens], tf.int64)
+    with tf.control_dependencies([done]):
+        return tf.nest.map_structure(tf.identity, data)
+
+
+class ThroughputLogger(Callback):
+    """Log training throughput every interval steps.
+
+    Reports examples and non-padding tokens per second as recorded in
+    stats by the model (see AccumulatingModel.input_stats), mean step
+    time, input wait and host memory to out and optionally as JSON lines
+    to metrics_file. Input wait is the time from the start of each step
+    until the step received its batch, i.e. the time spent blocked
+    fetching input.
+
+    If profile_steps=(start, end) is given, steps start to end
+    (inclusive) are traced with the TensorFlow profiler into profile_dir.
+    """
+
+    def __init__(self, stats, interval=100, metrics_file=None,
+                 profile_steps=None, profile_dir=None, initial_step=0,
+                 out=sys.stderr):
+        self._stats = stats
+        self._interval = interval
+        self._metrics_file = metrics_file
+        self._profile_steps = profile_steps
+        self._profile_dir = profile_dir
+        self._profiling = False
+        self._out = out
+        self._step = initial_step
+        self._epoch = 0
+        self._start_interval()
+
+    def _start_interval(self):
+        self._interval_start = time()
+        self._interval_steps = 0
+        self._step_time = 0
+        self._wait_time = 0
+        self._examples = self._stats.examples
+        self._tokens = self._stats.tokens
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        self._start_interval()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self._interval and self._interval_steps:
+            self.log()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if (self._profile_steps is not None and
+            self._step == self._profile_steps[0]):
+            print('Starting profiler at step {}'.format(self._step),
+                  file=self._out, flush=True)
+            tf.profiler.experimental.start(self._profile_dir)
+            self._profiling = True
+        self._batch_start = time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time()
+        self._step_time += end - self._batch_start
+        received = self._stats.first_received(self._batch_start, end)
+        if received is not None:
+            self._wait_time += received - self._batch_start
+        self._step += 1
+        self._interval_steps += 1
+        if self._profiling and self._step > self._profile_steps[1]:
+            self._stop_profiler()
+        if self._interval and self._step % self._interval == 0:
+            self.log()
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        tf.profiler.experimental.stop()
+        self._profiling = False
+        print('Wrote profiler trace to {}'.format(self._profile_dir),
+              file=self._out, flush=True)
+
+    def log(self):
+        elapsed = time() - self._interval_start
+        steps = self._interval_steps
+        metrics = {
+            'step': self._step,
+            'epoch': self._epoch + 1,
+            'examples_per_sec': (self._stats.examples-self._examples)/elapsed,
+            'tokens_per_sec': (self._stats.tokens-self._tokens)/elapsed,
+            'step_sec': self._step_time/steps,
+            'input_wait_sec': self._wait_time/steps,
+            'input_wait_fraction': self._wait_time/max(self._step_time, 1e-9),
+            'host_memory_mb': host_memory_mb(),
+        }
+        print('step {step}: {examples_per_sec:.1f} examples/sec, '
+              '{tokens_per_sec:.0f} tokens/sec, {step_sec:.3f} sec/step, '
+              'input wait {input_wait_fraction:.1%}, '
+              'host memory {host_memory_mb:.0f} MB'.format(**metrics),
+              file=self._out, flush=True)
+        if self._metrics_file is not None:
+            metrics['time'] = time()
+            with open(self._metrics_file, 'a') as out:
+                print(json.dumps(metrics), file=out)
+        self._start_interval()
 
 
 def load_batch_from_tsv(fn, base_ln, offset, batch_size, options,
@@ -547,20 +1946,115 @@ def num_tfrecord_examples(fn):
 def num_examples(fn):
     if isinstance(fn, list):
         return sum(num_examples(f) for f in fn)
+    if fn.endswith('.npy'):
+        return len(np.load(fn, mmap_mode='r'))
+    manifest = load_manifest(fn)
+    if manifest is not None:
+        return manifest['num_examples']
     elif fn.endswith('.tsv'):
         return num_tsv_examples(fn)
     elif fn.endswith('.tfrecord'):
         return num_tfrecord_examples(fn)
     else:
-        raise ValueError('file {} must be .tsv or .tfrecord'.format(fn))
+        raise ValueError('file {} must be .tsv, .tfrecord or .npy'.format(fn))
 
 
-def get_decode_function(max_seq_len):
-    name_to_features = {
+# Compact encoded data: token IDs in <name>.npy and labels and (optional)
+# lengths without trailing padding in <name>.npy.labels and
+# <name>.npy.lengths (in .npy format, but named so that globs for data
+# files do not match them). Segment IDs are all zero and not stored.
+NPY_TOKEN_DTYPE = np.uint16
+
+
+def _npy_sidecar_path(data_path, name):
+    return '{}.{}'.format(data_path, name)
+
+
+class NpyDataWriter(object):
+    """Write encoded examples into preallocated .npy files."""
+
+    def __init__(self, path, num_examples, seq_len, pad_id=0, lengths=True):
+        self.path = path
+        self.num_examples = num_examples
+        self.pad_id = pad_id
+        self.count = 0
+        self._token_ids = np.lib.format.open_memmap(
+            path, mode='w+', dtype=NPY_TOKEN_DTYPE,
+            shape=(num_examples, seq_len))
+        self._labels = np.lib.format.open_memmap(
+            _npy_sidecar_path(path, 'labels'), mode='w+', dtype=np.int32,
+            shape=(num_examples,))
+        if not lengths:
+            self._lengths = None
+        else:
+            self._lengths = np.lib.format.open_memmap(
+                _npy_sidecar_path(path, 'lengths'), mode='w+', dtype=np.int32,
+                shape=(num_examples,))
+
+    def write(self, token_ids, labels):
+        max_id = np.iinfo(NPY_TOKEN_DTYPE).max
+        if len(token_ids) and token_ids.max() > max_id:
+            raise ValueError('token ID {} exceeds {} for {}'.format(
+                token_ids.max(), max_id, self.path))
+        start, end = self.count, self.count+len(labels)
+        self._token_ids[start:end] = token_ids
+        self._labels[start:end] = labels
+        if self._lengths is not None:
+            self._lengths[start:end] = encoded_lengths(token_ids, self.pad_id)
+        self.count = end
+
+    def close(self):
+        if self.count != self.num_examples:
+            raise ValueError('wrote {} examples to {}, expected {}'.format(
+                self.count, self.path, self.num_examples))
+        for array in (self._token_ids, self._labels, self._lengths):
+            if array is not None:
+                array.flush()
+
+
+def load_npy_data(data_path):
+    """Return memory-mapped token IDs, labels and lengths (or None)."""
+    token_ids = np.load(data_path, mmap_mode='r')
+    labels = np.load(_npy_sidecar_path(data_path, 'labels'), mmap_mode='r')
+    if len(labels) != len(token_ids):
+        raise ValueError('{} token rows but {} labels in {}'.format(
+            len(token_ids), len(labels), data_path))
+    lengths_path = _npy_sidecar_path(data_path, 'lengths')
+    if os.path.exists(lengths_path):
+        lengths = np.load(lengths_path, mmap_mode='r')
+    else:
+        lengths = None
+    return token_ids, labels, lengths
+
+
+def check_npy_seq_len(token_ids, max_seq_len, data_path):
+    if token_ids.shape[1] != max_seq_len:
+        raise ValueError('{} has sequence length {}, expected {}'.format(
+            data_path, token_ids.shape[1], max_seq_len))
+
+
+def npy_inputs(token_ids, length=None):
+    """Return int32 token and segment ID matrices for rows of .npy data."""
+    t = np.array(token_ids[:, :length], dtype=np.int32)
+    return t, np.zeros_like(t)
+
+
+def load_npy_dataset(fn, max_seq_len):
+    token_ids, labels, _ = load_npy_data(fn)
+    check_npy_seq_len(token_ids, max_seq_len, fn)
+    return npy_inputs(token_ids), np.array(labels)
+
+
+def tfrecord_features(max_seq_len):
+    return {
         'Input-Token': tf.io.FixedLenFeature([max_seq_len], tf.int64),
         'Input-Segment': tf.io.FixedLenFeature([max_seq_len], tf.int64),
         'label': tf.io.FixedLenFeature([1], tf.int64),
     }
+
+
+def get_decode_function(max_seq_len):
+    name_to_features = tfrecord_features(max_seq_len)
     def decode_tfrecord(record):
         example = tf.io.parse_single_example(record, name_to_features)
         t = tf.cast(example['Input-Token'], tf.int32)
@@ -571,59 +2065,377 @@ def get_decode_function(max_seq_len):
     return decode_tfrecord
 
 
-def train_tfrecord_input(filenames, max_seq_len, batch_size, num_threads=10):
+def get_batch_decode_function(max_seq_len):
+    """Return function decoding a batch of serialized examples at once."""
+    name_to_features = tfrecord_features(max_seq_len)
+    def decode_tfrecords(records):
+        examples = tf.io.parse_example(records, name_to_features)
+        t = tf.cast(examples['Input-Token'], tf.int32)
+        s = tf.cast(examples['Input-Segment'], tf.int32)
+        y = tf.cast(examples['label'], tf.int32)
+        x = (t, s)
+        return x, y
+    return decode_tfrecords
+
+
+def cache_dataset(dataset, cache=None):
+    """Cache dataset in memory (cache='memory') or in the given file."""
+    if not cache:
+        return dataset
+    elif cache == 'memory':
+        return dataset.cache()
+    else:
+        return dataset.cache(cache)
+
+
+def set_deterministic(dataset, deterministic=True):
+    dataset_options = tf.data.Options()
+    dataset_options.experimental_deterministic = deterministic
+    return dataset.with_options(dataset_options)
+
+
+def get_trim_function(min_len, pad_id=0):
+    def trim_example(x, y):
+        t, s = x
+        nonpad = tf.cast(tf.not_equal(t, pad_id), tf.int32)
+        length = tf.shape(t)[0] - tf.argmax(tf.reverse(nonpad, [0]),
+                                            output_type=tf.int32)
+        length = tf.maximum(length, min_len)
+        return (t[:length], s[:length]), y
+    return trim_example
+
+
+def bucket_by_length(dataset, max_seq_len, batch_size, min_len, pad_id=0):
+    """Batch examples of similar length, padding only to the batch maximum."""
+    dataset = dataset.map(get_trim_function(min_len, pad_id),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    step = max(8, max_seq_len//8)
+    boundaries = list(range(min_len+step, max_seq_len+1, step))
+    return dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        lambda x, y: tf.shape(x[0])[0],
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=[batch_size] * (len(boundaries)+1),
+        padded_shapes=(([None], [None]), [1]),
+        padding_values=((pad_id, 0), 0),
+    ))
+
+
+def train_tfrecord_input(filenames, max_seq_len, batch_size,
+                         bucket_min_len=None, deterministic=True, cache=None,
+                         seed=None, skip_batches=0, num_threads=10):
     # Largely following BERT run_pretraining.py with is_training=True,
-    # including shuffling and parallel reading.
+    # including shuffling and parallel reading. Records are batched
+    # before parsing, which is much faster than parsing one at a time.
+    # With a seed and deterministic=True, skip_batches resumes the
+    # stream of batches exactly. At most num_threads files are open at
+    # once.
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
     dataset = tf.data.Dataset.from_tensor_slices(filenames)
-    dataset = dataset.repeat().shuffle(buffer_size=len(filenames))
-    max_concurrent = min(num_threads, len(filenames))
+    dataset = dataset.shuffle(buffer_size=len(filenames), seed=seed)
     dataset = dataset.interleave(
         tf.data.TFRecordDataset,
+        cycle_length=min(num_threads, len(filenames)),
+        num_parallel_calls=AUTOTUNE
+    )
+    # With a cache, later epochs repeat the file order of the first one
+    dataset = cache_dataset(dataset, cache)
+    dataset = dataset.repeat()
+    if bucket_min_len is None:
+        dataset = dataset.skip(skip_batches * batch_size)    # before parsing
+    decode = get_batch_decode_function(max_seq_len)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(decode, num_parallel_calls=AUTOTUNE)
+    if bucket_min_len is not None:
+        dataset = bucket_by_length(dataset.unbatch(), max_seq_len, batch_size,
+                                   bucket_min_len)
+        dataset = dataset.skip(skip_batches)
+    dataset = dataset.prefetch(AUTOTUNE)
+    return set_deterministic(dataset, deterministic)
+
+
+# Per-process state for tf.data TSV encoding workers, see init_tsv_worker()
+_tsv_worker_state = {}
+
+
+def init_tsv_worker(options, label_map):
+    _tsv_worker_state['options'] = options
+    _tsv_worker_state['label_map'] = label_map
+    _tsv_worker_state['tokenizer'] = get_tokenizer(options)
+
+
+def encode_tsv_lines(lines, line_numbers, filenames):
+    """Encode TSV lines into token IDs, segment IDs and labels."""
+    options = _tsv_worker_state['options']
+    labels, texts = [], []
+    for l, ln, fn in zip(lines, line_numbers, filenames):
+        label, text = parse_tsv_line(l, ln, fn, options)
+        labels.append(label)
+        texts.append(text)
+    x, y = encode_data(texts, labels, _tsv_worker_state['tokenizer'],
+                       options.max_seq_length, _tsv_worker_state['label_map'],
+                       options)
+    if getattr(options, 'bucket_by_length', False):
+        pad_id = _tsv_worker_state['tokenizer'].vocab['[PAD]']
+        x = trim_padding(x, int(options.max_seq_length/2) + 1, pad_id)
+    return x[0], x[1], y.astype(np.int32)
+
+
+def tsv_encoding_executor(label_map, options, num_workers=4):
+    """Return process pool for train_tsv_input(), to be shut down by caller."""
+    # Forking a process with an initialized TensorFlow runtime is unsafe
+    context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(num_workers, mp_context=context,
+                               initializer=init_tsv_worker,
+                               initargs=(options, label_map))
+
+
+def train_tsv_input(filenames, batch_size, options, executor, num_workers=4,
+                    num_threads=10, skip_batches=0):
+    """Return tf.data training input tokenizing TSV lines in subprocesses.
+
+    Lines are read from the files in parallel and batched before
+    encoding, and each batch is encoded in executor (see
+    tsv_encoding_executor()) with num_workers processes. The first
+    skip_batches batches are skipped without encoding.
+    """
+
+    def encode(lines, line_numbers, fns):
+        lines = [l.decode('utf-8') for l in lines]
+        fns = [fn.decode('utf-8') for fn in fns]
+        return executor.submit(encode_tsv_lines, lines, line_numbers.tolist(),
+                               fns).result()
+
+    def read_lines(fn):
+        # Keep file name and line number for error messages
+        lines = tf.data.TextLineDataset(fn).enumerate(start=1)
+        return lines.map(lambda ln, l: (l, ln, fn))
+
+    if getattr(options, 'bucket_by_length', False):
+        seq_len = None
+    else:
+        seq_len = options.max_seq_length
+
+    def encode_batch(lines, line_numbers, fns):
+        t, s, y = tf.numpy_function(encode, [lines, line_numbers, fns],
+                                    [tf.int32, tf.int32, tf.int32])
+        t.set_shape([None, seq_len])
+        s.set_shape([None, seq_len])
+        y.set_shape([None])
+        return (t, s), y
+
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.repeat().shuffle(buffer_size=len(filenames),
+                                       seed=options.seed)
+    max_concurrent = min(num_threads, len(filenames))
+    dataset = dataset.interleave(
+        read_lines,
         cycle_length=max_concurrent,
         num_parallel_calls=max_concurrent
     )
-    decode = get_decode_function(max_seq_len)
-    dataset = dataset.map(decode, num_parallel_calls=num_threads)
+    if options.shuffle_tsv:
+        dataset = dataset.shuffle(DEFAULT_SHUFFLE_BUFFER_SIZE,
+                                  seed=options.seed)
+    dataset = dataset.skip(skip_batches * batch_size)
     dataset = dataset.batch(batch_size)
-    dataset = dataset.prefetch(1)    # TODO optimize
+    dataset = dataset.map(encode_batch, num_parallel_calls=num_workers)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
     return dataset
 
 
-def load_tfrecords(fn, max_seq_len, batch_size):
-    decode = get_decode_function(max_seq_len)
-    # TODO support multiple TFRecords
-    dataset = tf.data.TFRecordDataset(fn)
-    dataset = dataset.map(decode, num_parallel_calls=10)    # TODO
-    dataset = dataset.repeat()
+def load_tfrecords(filenames, max_seq_len, batch_size, cache=None):
+    """Return batched dataset reading TFRecords once in file order."""
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+    decode = get_batch_decode_function(max_seq_len)
+    dataset = tf.data.TFRecordDataset(filenames)
     dataset = dataset.batch(batch_size)
-    dataset = dataset.prefetch(1)    # TODO optimize
+    dataset = dataset.map(decode, num_parallel_calls=AUTOTUNE)
+    dataset = cache_dataset(dataset, cache)
+    dataset = dataset.prefetch(AUTOTUNE)
     return dataset
 
 
+def dataset_labels(dataset):
+    """Return all labels of a dataset of (x, y) batches as a vector."""
+    return np.concatenate([y.numpy().reshape(-1) for _, y in dataset])
+
+
+def split_lines(data, encoding='utf-8'):
+    """Decode buffer and split it into lines without line terminators."""
+    lines = str(data, encoding).split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+# TsvSequence sorts examples by length within windows of this many batches
+BUCKET_WINDOW_BATCHES = 100
+
+
 class TsvSequence(Sequence):
-    def __init__(self, data_path, tokenizer, label_map, batch_size, options):
-        self._data_path = data_path
+    """Batches of encoded examples read from memory-mapped TSV files.
+
+    A single unshuffled file is read in contiguous batches. For several
+    files or with shuffle=True, examples are read line by line through
+    the line offset index, in an order reshuffled for every epoch.
+    Without shuffle=True, batches are read in shuffled order. The order
+    depends only on seed and epoch.
+
+    With options.bucket_by_length, examples are sorted by line length
+    within windows of BUCKET_WINDOW_BATCHES batches before batching, so
+    that batches hold examples of similar length, and batches are read
+    in shuffled order. Trailing padding is trimmed from each batch.
+
+    With read_ahead > 0, the following read_ahead batches are read and
+    encoded by background threads when batches are requested in order
+    (as by fit() with shuffle=False and a single worker).
+    """
+
+    def __init__(self, data_paths, tokenizer, label_map, batch_size, options,
+                 read_ahead=0, shuffle=False, seed=None):
+        if isinstance(data_paths, str):
+            data_paths = [data_paths]
+        self._data_paths = data_paths
         self._tokenizer = tokenizer
         self._label_map = label_map
         self._batch_size = batch_size
         self._max_seq_len = options.max_seq_length
         self._options = options
-        offsets, total = load_batch_offsets(data_path, batch_size)
-        self._batch_offsets = offsets
+        bucket = getattr(options, 'bucket_by_length', False)
+        if bucket:
+            self._pad_id = tokenizer.vocab['[PAD]']
+            self._min_len = int(options.max_seq_length/2) + 1
+        else:
+            self._pad_id = None
+        if len(data_paths) == 1 and not shuffle and not bucket:
+            offsets, total = load_batch_offsets(data_paths[0], batch_size)
+            self._batch_offsets = offsets + [os.path.getsize(data_paths[0])]
+            self._line_index = None
+        else:
+            self._line_index = [load_line_index(fn) for fn in data_paths]
+            counts = [len(index)-1 for index in self._line_index]
+            self._file_starts = np.cumsum([0] + counts)
+            total = int(self._file_starts[-1])
+            self._order = np.arange(total)
+            if bucket:
+                # Line length in bytes as proxy for encoded length
+                self._line_lengths = np.concatenate(
+                    [np.diff(index) for index in self._line_index])
         self.num_examples = total
+        self._shuffle = shuffle
+        self._seed = seed if seed is not None else np.random.randint(2**31)
+        self._local = threading.local()
+        self._read_ahead = read_ahead
+        if read_ahead:
+            self._executor = ThreadPoolExecutor(read_ahead)
+            self._prefetched = {}
+            self._prefetch_lock = threading.Lock()
+            self._next_idx = 0
+        self.set_epoch(0)
 
     def __len__(self):
-        return len(self._batch_offsets)
+        if self._line_index is None:
+            return len(self._batch_offsets) - 1
+        else:
+            return int(np.ceil(self.num_examples / self._batch_size))
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+        rng = np.random.RandomState(self._seed + epoch)
+        if self._shuffle:
+            self._order = rng.permutation(self.num_examples)
+        if self._pad_id is not None:
+            self._order = self._bucketed_order(self._order)
+        if not self._shuffle or self._pad_id is not None:
+            self._batch_order = rng.permutation(len(self))
+        else:
+            self._batch_order = None
+        if self._read_ahead:
+            with self._prefetch_lock:
+                for future in self._prefetched.values():
+                    future.cancel()
+                self._prefetched.clear()
+                self._next_idx = 0
+
+    def _bucketed_order(self, order):
+        window = BUCKET_WINDOW_BATCHES * self._batch_size
+        order = order.copy()
+        for start in range(0, len(order), window):
+            w = order[start:start+window]
+            lengths = self._line_lengths[w]
+            order[start:start+window] = w[np.argsort(lengths, kind='stable')]
+        return order
+
+    def _data_views(self):
+        # One mapping per file for each worker thread or process
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.views = []
+            for fn in self._data_paths:
+                with open(fn, 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                local.views.append(memoryview(m))
+            local.pid = os.getpid()
+        return local.views
+
+    def _load_batch(self, idx):
+        if self._batch_order is not None:
+            idx = self._batch_order[idx]
+        if self._line_index is None:
+            return self._load_contiguous_batch(idx)
+        views = self._data_views()
+        examples = self._order[idx*self._batch_size:(idx+1)*self._batch_size]
+        file_indices = np.searchsorted(self._file_starts, examples, 'right')-1
+        labels, texts = [], []
+        for i, f in zip(examples, file_indices):
+            line = i - self._file_starts[f]
+            start, end = self._line_index[f][line:line+2]
+            [l] = split_lines(views[f][start:end])
+            label, text = parse_tsv_line(l, line+1, self._data_paths[f],
+                                         self._options)
+            labels.append(label)
+            texts.append(text)
+        return labels, texts
+
+    def _load_contiguous_batch(self, idx):
+        start, end = self._batch_offsets[idx], self._batch_offsets[idx+1]
+        base_ln = idx * self._batch_size + 1
+        labels, texts = [], []
+        lines = split_lines(self._data_views()[0][start:end])
+        for ln, l in enumerate(lines, start=base_ln):
+            label, text = parse_tsv_line(l, ln, self._data_paths[0],
+                                         self._options)
+            labels.append(label)
+            texts.append(text)
+        return labels, texts
 
-    def __getitem__(self, idx):
-        base_ln = idx * self._batch_size
-        offset = self._batch_offsets[idx]
-        labels, texts = load_batch_from_tsv(self._data_path, base_ln, offset,
-                                            self._batch_size, self._options)
+    def _encode_batch(self, idx):
+        labels, texts = self._load_batch(idx)
         x, y = encode_data(texts, labels, self._tokenizer, self._max_seq_len,
                         self._label_map, self._options)      
+        if self._pad_id is not None:
+            x = trim_padding(x, self._min_len, self._pad_id)
         return x, y
 
-    def __on_epoch_end__(self):
-        pass
+    def __getitem__(self, idx):
+        if not self._read_ahead:
+            return self._encode_batch(idx)
+        with self._prefetch_lock:
+            future = self._prefetched.pop(idx, None)
+            sequential, self._next_idx = idx == self._next_idx, idx+1
+            if sequential:
+                # Reading ahead is only useful if batches come in order
+                ahead = range(idx+1, min(idx+1+self._read_ahead, len(self)))
+                for i in list(self._prefetched):
+                    if i not in ahead:
+                        self._prefetched.pop(i).cancel()
+                for i in ahead:
+                    if i not in self._prefetched:
+                        self._prefetched[i] = self._executor.submit(
+                            self._encode_batch, i)
+        if future is None:
+            return self._encode_batch(idx)
+        return future.result()
+
+    def on_epoch_end(self):
+        self.set_epoch(self._epoch + 1)
 
@@ -6,5 +6,10 @@ DEFAULT_EPOCHS = 4
 DEFAULT_LR = 5e-5
 DEFAULT_WARMUP_PROPORTION = 0.1
 DEFAULT_MAX_CHECKPOINTS = 10
+DEFAULT_TOKENIZER_CACHE_SIZE = 100000
+DEFAULT_SHUFFLE_BUFFER_SIZE = 10000
+DEFAULT_LOG_INTERVAL = 100
+DEFAULT_DISTILL_TEMPERATURE = 2.0
+DEFAULT_DISTILL_ALPHA = 0.5
 
 CHECKPOINT_NAME = 'ckpt-epoch-{epoch}-loss-{loss:.4f}.h5'
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Convert TSV or TFRecord data into compact memory-mapped .npy files
+# (see NpyDataWriter in common.py).
+
+import sys
+
+import numpy as np
+
+from argparse import ArgumentParser
+
+from common import load_labels, parse_tsv_line, encode_data, num_examples
+from common import load_manifest, load_tfrecords, write_manifest
+from common import NpyDataWriter, get_tokenizer, encoding_config
+from create_tfrecords import ENCODE_BATCH_SIZE
+from config import DEFAULT_SEQ_LEN, DEFAULT_TOKENIZER_CACHE_SIZE
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument(
+        '--input_file', required=True,
+        help='Input data in TSV format, or comma-separated TFRecord files'
+    )
+    ap.add_argument(
+        '--output_file', required=True,
+        help='Output token ID file (.npy)'
+    )
+    ap.add_argument(
+        '--labels', default=None,
+        help='File containing list of labels (TSV input)'
+    )
+    ap.add_argument(
+        '--vocab_file', default=None,
+        help='Vocabulary file that BERT model was trained on (TSV input)'
+    )
+    ap.add_argument(
+        '--max_seq_length', type=int, default=None,
+        help='Maximum input sequence length in WordPieces (default {} for '
+        'TSV, from manifest for TFRecords)'.format(DEFAULT_SEQ_LEN)
+    )
+    ap.add_argument(
+        '--do_lower_case', default=False, action='store_true',
+        help='Lower case input text (for uncased models)'
+    )
+    ap.add_argument(
+        '--task_name', default="NER",
+        help='task to run, acceptable values NER and RE'
+    )
+    ap.add_argument(
+        '--replace_span', default=None,
+        help='Replace span text with given special token'
+    )
+    ap.add_argument(
+        '--replace_span_A', default=None,
+        help='Replace span text with given special token for first entity in RE'
+    )
+    ap.add_argument(
+        '--replace_span_B', default=None,
+        help='Replace span text with given special token for second entity in RE'
+    )
+    ap.add_argument(
+        '--label_field', type=int, default=-4,
+        help='Index of label in TSV data (1-based)'
+    )
+    ap.add_argument(
+        '--text_fields', type=int, default=-3,
+        help='Index of first text field in TSV data (1-based)'
+    )
+    ap.add_argument(
+        '--tokenizer_cache_size', type=int,
+        default=DEFAULT_TOKENIZER_CACHE_SIZE,
+        help='Maximum number of cached word tokenizations (0 to disable)'
+    )
+    ap.add_argument(
+        '--no_lengths', default=False, action='store_true',
+        help='Do not write sequence lengths'
+    )
+    return ap
+
+
+def convert_tsv(options):
+    if options.vocab_file is None or options.labels is None:
+        raise ValueError('--vocab_file and --labels required for TSV input')
+    if options.max_seq_length is None:
+        options.max_seq_length = DEFAULT_SEQ_LEN
+    tokenizer = get_tokenizer(options)
+    label_map = { l: i for i, l in enumerate(load_labels(options.labels)) }
+    fn = options.input_file
+    writer = NpyDataWriter(options.output_file, num_examples(fn),
+                           options.max_seq_length, tokenizer.vocab['[PAD]'],
+                           not options.no_lengths)
+
+    def write(texts, labels):
+        (t, s), y = encode_data(texts, labels, tokenizer,
+                                options.max_seq_length, label_map, options)
+        writer.write(t, y)
+
+    labels, texts = [], []
+    with open(fn) as f:
+        for ln, l in enumerate(f, start=1):
+            label, text = parse_tsv_line(l, ln, fn, options)
+            labels.append(label)
+            texts.append(text)
+            if len(texts) >= ENCODE_BATCH_SIZE:
+                write(texts, labels)
+                labels, texts = [], []
+    if texts:
+        write(texts, labels)
+    writer.close()
+    encoding = encoding_config(options)
+    encoding['input_file'] = fn
+    return writer.count, encoding
+
+
+def convert_tfrecords(options):
+    filenames = options.input_file.split(',')
+    manifest = load_manifest(filenames[0])
+    encoding = manifest.get('encoding') if manifest is not None else None
+    if options.max_seq_length is None:
+        if encoding is None:
+            raise ValueError('--max_seq_length required, no manifest for '
+                             '{}'.format(filenames[0]))
+        options.max_seq_length = encoding['max_seq_length']
+    # [PAD] is assumed to have ID 0, as in the standard BERT vocabs
+    writer = NpyDataWriter(options.output_file, num_examples(filenames),
+                           options.max_seq_length, 0, not options.no_lengths)
+    dataset = load_tfrecords(filenames, options.max_seq_length,
+                             ENCODE_BATCH_SIZE)
+    for (t, s), y in dataset:
+        if np.any(s.numpy()):
+            raise ValueError('non-zero segment IDs cannot be stored')
+        writer.write(t.numpy(), y.numpy().reshape(-1))
+    writer.close()
+    if encoding is not None:
+        encoding = dict(encoding, input_file=options.input_file)
+    return writer.count, encoding
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+
+    if args.task_name not in ('NER', 'RE'):
+        raise ValueError('Task not found: {}'.format(args.task_name))
+    if not args.output_file.endswith('.npy'):
+        raise ValueError('--output_file must be .npy')
+
+    if args.input_file.endswith('.tsv'):
+        count, encoding = convert_tsv(args)
+    elif args.input_file.endswith('.tfrecord'):
+        count, encoding = convert_tfrecords(args)
+    else:
+        raise ValueError('--input_file must be .tsv or .tfrecord')
+    write_manifest(args.output_file, count, encoding)
+
+    print('wrote {} examples to {}'.format(count, args.output_file),
+          file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
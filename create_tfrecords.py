@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 
 import tensorflow as tf
 
-import bert_tokenization as tokenization
-
 from collections import OrderedDict
 from argparse import ArgumentParser
+from multiprocessing import Pool
 
-from common import load_labels, tsv_generator
-from config import DEFAULT_SEQ_LEN
+from common import load_labels, parse_tsv_line, encode_data
+from common import write_manifest, encoding_config, get_tokenizer
+from config import DEFAULT_SEQ_LEN, DEFAULT_TOKENIZER_CACHE_SIZE
 
 
 def argparser():
@@ -39,10 +40,22 @@ def argparser():
         '--do_lower_case', default=False, action='store_true',
         help='Lower case input text (for uncased models)'
     )
+    ap.add_argument(
+        '--task_name', default="NER",
+        help='task to run, acceptable values NER and RE'
+    )
     ap.add_argument(
         '--replace_span', default=None,
         help='Replace span text with given special token'
     )
+    ap.add_argument(
+        '--replace_span_A', default=None,
+        help='Replace span text with given special token for first entity in RE'
+    )
+    ap.add_argument(
+        '--replace_span_B', default=None,
+        help='Replace span text with given special token for second entity in RE'
+    )
     ap.add_argument(
         '--label_field', type=int, default=-4,
         help='Index of label in TSV data (1-based)'
@@ -55,6 +68,19 @@ def argparser():
         '--max_examples', type=int, default=None,
         help='Maximum number of examples to generate'
     )
+    ap.add_argument(
+        '--tokenizer_cache_size', type=int,
+        default=DEFAULT_TOKENIZER_CACHE_SIZE,
+        help='Maximum number of cached word tokenizations (0 to disable)'
+    )
+    ap.add_argument(
+        '--num_workers', type=int, default=1,
+        help='Number of processes to encode data with'
+    )
+    ap.add_argument(
+        '--num_shards', type=int, default=None,
+        help='Number of output files (default: one per worker)'
+    )
     return ap
 
 
@@ -85,6 +111,75 @@ def create_int_feature(values):
     return feature
 
 
+# Number of TSV lines to tokenize and encode together
+ENCODE_BATCH_SIZE = 1000
+
+
+def shard_path(output_file, index, num_shards):
+    if num_shards == 1:
+        return output_file
+    base, ext = os.path.splitext(output_file)
+    return '{}-{:05d}-of-{:05d}{}'.format(base, index, num_shards, ext)
+
+
+def line_aligned_offset(f, offset):
+    """Return the offset of the first line starting at or after offset."""
+    if offset == 0:
+        return 0
+    f.seek(offset-1)
+    f.readline()
+    return f.tell()
+
+
+def shard_offsets(fn, num_shards, max_examples=None):
+    """Split file into num_shards line-aligned (start, end) byte ranges."""
+    with open(fn, 'rb') as f:
+        if max_examples is None:
+            size = os.path.getsize(fn)
+        else:
+            for _ in range(max_examples):
+                if not f.readline():
+                    break
+            size = f.tell()
+        bounds = [
+            min(line_aligned_offset(f, size*i//num_shards), size)
+            for i in range(num_shards)
+        ]
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_lines(fn, start, end, encoding='utf-8'):
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            yield f.readline().decode(encoding)
+
+
+def encoded_examples(fn, start, end, tokenizer, label_map, options):
+    """Generate Examples for the TSV lines in the given byte range."""
+    source = '{} (bytes {}-{})'.format(fn, start, end)
+    labels, texts = [], []
+    for ln, l in enumerate(read_lines(fn, start, end), start=1):
+        label, text = parse_tsv_line(l, ln, source, options)
+        labels.append(label)
+        texts.append(text)
+        if len(texts) >= ENCODE_BATCH_SIZE:
+            yield from encode_examples(texts, labels, tokenizer, label_map,
+                                       options)
+            labels, texts = [], []
+    if texts:
+        yield from encode_examples(texts, labels, tokenizer, label_map,
+                                   options)
+
+
+def encode_examples(texts, labels, tokenizer, label_map, options):
+    (t, s), y = encode_data(texts, labels, tokenizer, options.max_seq_length,
+                            label_map, options)
+    for i in range(len(y)):
+        yield Example((t[i], s[i]), y[i])
+
+
 def write_examples(examples, output_file):
     count = 0
     with tf.io.TFRecordWriter(output_file) as writer:
@@ -93,25 +188,60 @@ def write_examples(examples, output_file):
             writer.write(tf_example.SerializeToString())
             count += 1
     print('wrote {} examples to {}'.format(count, output_file), file=sys.stderr)
+    return count
 
 
-def main(argv):
-    args = argparser().parse_args(argv[1:])
+# Per-process state for shard workers, see init_worker()
+_worker_state = {}
 
-    tokenizer = tokenization.FullTokenizer(
-        vocab_file=args.vocab_file,
-        do_lower_case=args.do_lower_case
-    )
-    label_list = load_labels(args.labels)
-    label_map = { l: i for i, l in enumerate(label_list) }
 
-    examples = []
-    for x, y in tsv_generator(args.input_file, tokenizer, label_map, args):
-        examples.append(Example(x, y))
-        if args.max_examples and len(examples) >= args.max_examples:
-            break
+def init_worker(options):
+    _worker_state['options'] = options
+    _worker_state['tokenizer'] = get_tokenizer(options)
+    label_list = load_labels(options.labels)
+    _worker_state['label_map'] = { l: i for i, l in enumerate(label_list) }
+
+
+def write_shard(shard):
+    output_file, start, end = shard
+    options = _worker_state['options']
+    examples = encoded_examples(options.input_file, start, end,
+                                _worker_state['tokenizer'],
+                                _worker_state['label_map'], options)
+    count = write_examples(examples, output_file)
+    encoding = encoding_config(options)
+    encoding['input_file'] = options.input_file
+    encoding['input_bytes'] = [start, end]
+    write_manifest(output_file, count, encoding)
+    return count
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
 
-    write_examples(examples, args.output_file)
+    if args.task_name not in ('NER', 'RE'):
+        raise ValueError('Task not found: {}'.format(args.task_name))
+    num_shards = args.num_shards or args.num_workers
+    num_workers = min(args.num_workers, num_shards)
+
+    offsets = shard_offsets(args.input_file, num_shards, args.max_examples)
+    shards = [
+        (shard_path(args.output_file, i, num_shards), start, end)
+        for i, (start, end) in enumerate(offsets)
+    ]
+
+    if num_workers == 1:
+        init_worker(args)
+        counts = [write_shard(shard) for shard in shards]
+        print('Tokenizer cache: {}'.format(
+            _worker_state['tokenizer'].cache_info()), file=sys.stderr)
+    else:
+        with Pool(num_workers, initializer=init_worker,
+                  initargs=(args,)) as pool:
+            counts = pool.map(write_shard, shards, chunksize=1)
+
+    print('wrote {} examples to {} files'.format(sum(counts), len(shards)),
+          file=sys.stderr)
 
     return 0
 
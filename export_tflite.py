@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Export a trained model as a quantized TFLite model for CPU inference.
+# The output directory can be given as --model_dir to predict.py, test.py
+# and serve.py.
+
+import sys
+
+import tensorflow as tf
+
+from argparse import ArgumentParser
+
+from common import load_model_etc, apply_model_config, load_tsv_data
+from common import encode_texts, save_tflite_model_etc
+from config import DEFAULT_TOKENIZER_CACHE_SIZE
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument(
+        '--model_dir', required=True,
+        help='Trained model directory'
+    )
+    ap.add_argument(
+        '--output_dir', required=True,
+        help='Directory to save quantized model in'
+    )
+    ap.add_argument(
+        '--quantization', choices=('dynamic', 'int8'), default='int8',
+        help='Quantize weights only (dynamic) or also activations (int8)'
+    )
+    ap.add_argument(
+        '--representative_data', default=None,
+        help='TSV data for calibrating activation ranges (int8)'
+    )
+    ap.add_argument(
+        '--num_calibration_examples', type=int, default=200,
+        help='Number of representative examples to calibrate with'
+    )
+    ap.add_argument(
+        '--label_field', type=int, default=None,
+        help='Index of label in TSV data (1-based, default from model)'
+    )
+    ap.add_argument(
+        '--text_fields', type=int, default=None,
+        help='Index of first text field in TSV data (1-based, default '
+        'from model)'
+    )
+    ap.add_argument(
+        '--output_position_only', default=False, action='store_true',
+        help='Compute BERT output layer only at the classified position'
+    )
+    ap.add_argument(
+        '--tokenizer_cache_size', type=int,
+        default=DEFAULT_TOKENIZER_CACHE_SIZE,
+        help='Maximum number of cached word tokenizations (0 to disable)'
+    )
+    return ap
+
+
+def representative_dataset(model, tokenizer, config, options):
+    _, texts = load_tsv_data(options.representative_data, options)
+    texts = texts[:options.num_calibration_examples]
+    x = encode_texts(texts, tokenizer, config['max_seq_length'], options)
+    dtypes = [i.dtype.as_numpy_dtype for i in model.inputs]
+
+    def generate():
+        for i in range(len(texts)):
+            yield [v[i:i+1].astype(d) for v, d in zip(x, dtypes)]
+    return generate
+
+
+def convert(model, tokenizer, config, options):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    # Ops without TFLite builtins (e.g. erf in GELU) run as TF ops
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    if options.quantization == 'int8':
+        converter.representative_dataset = representative_dataset(
+            model, tokenizer, config, options)
+    return converter.convert()
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+
+    if args.quantization == 'int8' and args.representative_data is None:
+        raise ValueError('--representative_data required for int8')
+
+    model, tokenizer, labels, config = load_model_etc(
+        args.model_dir, args.tokenizer_cache_size,
+        output_position_only=args.output_position_only)
+    if config.get('max_spans'):
+        raise NotImplementedError('exporting multi-span models')
+    apply_model_config(args, config)
+
+    tflite_model = convert(model, tokenizer, config, args)
+    config = dict(config, quantization=args.quantization,
+                  input_names=model.input_names,
+                  output_position_only=bool(
+                      args.output_position_only or
+                      config.get('output_position_only')))
+    save_tflite_model_etc(tflite_model, args.model_dir, args.output_dir,
+                          config)
+
+    print('wrote {:.1f}M {} model to {}'.format(
+        len(tflite_model)/2**20, args.quantization, args.output_dir),
+          file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import sys
+
+from argparse import ArgumentParser
+
+from common import scan_line_offsets, write_manifest, verify_manifest
+
+
+def argparser():
+    ap = ArgumentParser(
+        description='Write manifest and line offset index for TSV data'
+    )
+    ap.add_argument(
+        '--verify', default=False, action='store_true',
+        help='Check file contents against existing manifests instead'
+    )
+    ap.add_argument('input_file', nargs='+', help='Input TSV file(s)')
+    return ap
+
+
+def index_tsv(fn):
+    offsets = scan_line_offsets(fn)
+    write_manifest(fn, len(offsets), line_offsets=offsets)
+    print('indexed {} lines in {}'.format(len(offsets), fn), file=sys.stderr)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.verify:
+        failed = [fn for fn in args.input_file if not verify_manifest(fn)]
+        for fn in failed:
+            print('{} does not match its manifest'.format(fn),
+                  file=sys.stderr)
+        return 1 if failed else 0
+    for fn in args.input_file:
+        index_tsv(fn)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Support for classifying several candidate spans of a text in a single
+# encoder pass. Candidates that share a group key (e.g. PMID) and whose
+# contexts overlap are packed into one sequence, and the model reads the
+# output at the position of each candidate instead of the center.
+
+import sys
+
+import numpy as np
+
+from common import parse_tsv_line, encode_token_rows
+
+
+# Minimum number of characters shared by two contexts to merge them
+DEFAULT_MIN_OVERLAP = 20
+
+
+class CandidateGroup(object):
+    def __init__(self, key, text, span, row):
+        self.key = key
+        self.text = text
+        self.spans = [(span[0], span[1], row)]
+        self.piece_lengths = {}    # token counts, see group_length()
+
+    def merged(self, text, span, row, offset):
+        """Return copy with (text, span) added at offset relative to self."""
+        if offset >= 0:
+            merged_text = self.text + text[len(self.text)-offset:]
+            group_shift, row_shift = 0, offset
+        else:
+            merged_text = text + self.text[len(text)+offset:]
+            group_shift, row_shift = -offset, 0
+        start, end = span[0]+row_shift, span[1]+row_shift
+        spans = [(s+group_shift, e+group_shift, r) for s, e, r in self.spans]
+        for s, e, r in spans:
+            if start < e and s < end:
+                return None    # candidate spans overlap
+        group = CandidateGroup(self.key, merged_text, (start, end), row)
+        group.spans = sorted(spans + group.spans)
+        return group
+
+
+def overlap_offset(text, other, min_overlap=DEFAULT_MIN_OVERLAP):
+    """Return offset of other relative to text if they overlap, else None."""
+    if len(text) < min_overlap or len(other) < min_overlap:
+        return None
+    for a, b, sign in ((text, other, 1), (other, text, -1)):
+        # b starts inside a
+        head = b[:min_overlap]
+        i = a.find(head)
+        while i >= 0:
+            n = min(len(a)-i, len(b))
+            if a[i:i+n] == b[:n]:
+                return sign * i
+            i = a.find(head, i+1)
+    return None
+
+
+def group_pieces(group):
+    """Return (is_span, text) pieces of group tokenized separately."""
+    pieces, prev = [], 0
+    for start, end, _ in group.spans:
+        pieces.append((False, group.text[prev:start]))
+        pieces.append((True, group.text[start:end]))
+        prev = end
+    pieces.append((False, group.text[prev:]))
+    return pieces
+
+
+def group_length(group, tokenizer, replace_span, known):
+    """Return number of WordPiece tokens in group (see tokenize_group).
+
+    Token counts of pieces are looked up in and added to known, so only
+    the pieces changed by merging a candidate are tokenized.
+    """
+    length = 0
+    for piece in group_pieces(group):
+        is_span, text = piece
+        if is_span and replace_span:
+            length += 1
+            continue
+        if piece not in known:
+            if is_span:
+                known[piece] = len(tokenizer.tokenize_text(text))
+            else:
+                known[piece] = len(tokenizer.tokenize(text))
+        length += known[piece]
+    return length
+
+
+def tokenize_group(group, tokenizer, replace_span):
+    """Return WordPiece tokens of group and the position of each span."""
+    tokens, positions = [], []
+    prev = 0
+    for start, end, _ in group.spans:
+        tokens.extend(tokenizer.tokenize(group.text[prev:start]))
+        positions.append(len(tokens))
+        if not replace_span:
+            tokens.extend(tokenizer.tokenize_text(group.text[start:end]))
+        else:
+            tokens.append(replace_span)
+        prev = end
+    tokens.extend(tokenizer.tokenize(group.text[prev:]))
+    return tokens, positions
+
+
+def group_candidates(keys, texts, tokenizer, seq_len, max_spans, options,
+                     min_overlap=DEFAULT_MIN_OVERLAP):
+    """Pack (left, span, right) candidates into groups sharing a context.
+
+    Candidates are only grouped if they have the same key, their
+    contexts overlap by at least min_overlap characters, their spans do
+    not overlap, and the combined context fits in seq_len.
+    """
+    groups, open_groups = [], {}
+    for row, (key, (left, span, right)) in enumerate(zip(keys, texts)):
+        text = left + span + right
+        span_offsets = (len(left), len(left)+len(span))
+        for group in open_groups.get(key, []):
+            if len(group.spans) >= max_spans:
+                continue
+            offset = overlap_offset(group.text, text, min_overlap)
+            if offset is None:
+                continue
+            merged = group.merged(text, span_offsets, row, offset)
+            if merged is None:
+                continue
+            known = group.piece_lengths
+            length = group_length(merged, tokenizer, options.replace_span,
+                                  known)
+            if length > seq_len-2:    # -2 for [CLS] and [SEP]
+                continue
+            group.text, group.spans = merged.text, merged.spans
+            group.piece_lengths = {
+                p: known[p] for p in group_pieces(group) if p in known
+            }
+            break
+        else:
+            group = CandidateGroup(key, text, span_offsets, row)
+            open_groups.setdefault(key, []).append(group)
+            groups.append(group)
+    print('Packed {} candidates into {} sequences'.format(
+        len(texts), len(groups)), file=sys.stderr, flush=True)
+    return groups
+
+
+def encode_groups(groups, tokenizer, seq_len, max_spans, replace_span):
+    """Encode groups into token, segment and position ID matrices.
+
+    Also returns a (num_groups, max_spans) matrix mapping each position
+    to its original row, with -1 for unused slots.
+    """
+    rows, positions = [], np.zeros((len(groups), max_spans), dtype=np.int32)
+    row_index = np.full((len(groups), max_spans), -1, dtype=np.int64)
+    budget = seq_len-2    # -2 for [CLS] and [SEP]
+    for i, group in enumerate(groups):
+        tokens, span_positions = tokenize_group(group, tokenizer,
+                                                replace_span)
+        # Single candidates with long contexts are cut around their span
+        lo, hi = span_positions[0], span_positions[-1]
+        start = max(0, min((lo+hi)//2 - budget//2, len(tokens)-budget, lo))
+        rows.append((0, tokens[start:]))
+        for j, (pos, (_, _, row)) in enumerate(zip(span_positions,
+                                                   group.spans)):
+            positions[i, j] = min(pos-start+1, seq_len-1)    # +1 for [CLS]
+            row_index[i, j] = row
+    token_ids, segment_ids = encode_token_rows(rows, tokenizer, seq_len)
+    return (token_ids, segment_ids, positions), row_index
+
+
+def load_grouped_tsv_data(fn, options):
+    keys, labels, texts = [], [], []
+    with open(fn) as f:
+        for ln, l in enumerate(f, start=1):
+            label, text = parse_tsv_line(l, ln, fn, options)
+            keys.append(l.rstrip('\n').split('\t')[options.group_field])
+            labels.append(label)
+            texts.append(text)
+    return keys, labels, texts
+
+
+def ungroup(values, row_index, num_rows):
+    """Map per-slot values of grouped data back to original row order."""
+    mask = row_index >= 0
+    result = np.zeros((num_rows,) + values.shape[2:], dtype=values.dtype)
+    result[row_index[mask]] = values[mask]
+    return result
+
+
+def load_grouped_dataset(fn, tokenizer, max_seq_len, label_map, options):
+    """Load TSV data packed into multi-span sequences.
+
+    Returns inputs, per-slot labels and sample weights, the slot to row
+    mapping and the labels of the original rows.
+    """
+    if options.task_name != 'NER':
+        raise NotImplementedError('multi-span encoding for NER only')
+    keys, labels, texts = load_grouped_tsv_data(fn, options)
+    groups = group_candidates(keys, texts, tokenizer, max_seq_len,
+                              options.max_spans, options)
+    x, row_index = encode_groups(groups, tokenizer, max_seq_len,
+                                 options.max_spans, options.replace_span)
+    row_labels = np.array([label_map[l] for l in labels])
+    mask = row_index >= 0
+    y = np.where(mask, row_labels[np.maximum(row_index, 0)], 0)
+    w = mask.astype(np.float32)
+    return x, y, w, row_index, row_labels
@@ -2,31 +2,179 @@ import os
 import sys
 
 import numpy as np
+import multiprocessing
+
+from logging import warning
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from common import argument_parser
-from common import load_model_etc, load_tsv_data
-from common import tokenize_texts, encode_tokenized
+from common import load_model_etc, load_model_config, load_model_tokenizer
+from common import apply_model_config, load_tsv_data, parse_tsv_line
+from common import encode_texts, num_examples, TopKWriter
+from common import has_variable_length_input, predict_bucketed
+from common import load_npy_data, check_npy_seq_len, npy_inputs
+from common import create_prediction_cache
+from multispan import load_grouped_tsv_data, group_candidates
+from multispan import encode_groups, ungroup
+
+
+def predict_encoded(model, x, tokenizer, options, cache=None):
+    if cache is not None:
+        return cache.predict(
+            lambda x: predict_encoded(model, x, tokenizer, options), x)
+    elif options.bucket_by_length:
+        return predict_bucketed(model, x, options.batch_size,
+                                tokenizer.vocab['[PAD]'])
+    else:
+        return model.predict(x, batch_size=options.batch_size)
+
+
+def write_predictions(probs, labels, options, probs_writer=None,
+                      out=sys.stdout):
+    if probs_writer is not None:
+        probs_writer.write(probs)
+    preds = np.argmax(probs, axis=-1)
+    for p, prob in zip(preds, probs):
+        if not options.output_probs:
+            print(labels[p], file=out)
+        else:
+            print('\t'.join([labels[p]] + ['{:.6f}'.format(v) for v in prob]),
+                  file=out)
+    out.flush()
+
+
+def read_chunks(fn, chunk_size):
+    chunk, first_ln = [], 1
+    with open(fn) as f:
+        for ln, l in enumerate(f, start=1):
+            chunk.append(l)
+            if len(chunk) >= chunk_size:
+                yield first_ln, chunk
+                chunk, first_ln = [], ln+1
+    if chunk:
+        yield first_ln, chunk
+
+
+def npy_chunks(fn, max_seq_len, chunk_size=None):
+    token_ids, _, _ = load_npy_data(fn)
+    check_npy_seq_len(token_ids, max_seq_len, fn)
+    chunk_size = chunk_size or len(token_ids)
+    for start in range(0, len(token_ids), chunk_size):
+        yield npy_inputs(token_ids[start:start+chunk_size])
+
+
+# Per-process state for chunk encoding workers, see init_worker()
+_worker_state = {}
+
+
+def init_worker(options):
+    config = load_model_config(options.model_dir)
+    _worker_state['options'] = options
+    _worker_state['config'] = config
+    _worker_state['tokenizer'] = load_model_tokenizer(
+        options.model_dir, config, options.tokenizer_cache_size)
+
+
+def encode_chunk(first_ln, lines):
+    options = _worker_state['options']
+    texts = []
+    for ln, l in enumerate(lines, start=first_ln):
+        _, text = parse_tsv_line(l, ln, options.test_data, options)
+        texts.append(text)
+    return encode_texts(texts, _worker_state['tokenizer'],
+                        options.max_seq_length, options)
+
+
+def stream_encoded(options):
+    """Generate encoded chunks of test data in order.
+
+    Chunks are encoded by a pool of worker processes, keeping at most
+    two chunks per worker in flight to bound memory use.
+    """
+    max_pending = 2 * options.num_workers
+    # Forking a process with an initialized TensorFlow runtime is unsafe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(options.num_workers, mp_context=context,
+                             initializer=init_worker,
+                             initargs=(options,)) as executor:
+        pending = deque()
+        for first_ln, lines in read_chunks(options.test_data,
+                                           options.chunk_size):
+            pending.append(executor.submit(encode_chunk, first_ln, lines))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def main(argv):
     args = argument_parser('predict').parse_args(argv[1:])
 
-    model, tokenizer, labels, config = load_model_etc(args.model_dir)
-    _, test_texts = load_tsv_data(args.test_data, args)
+    model, tokenizer, labels, config = load_model_etc(
+        args.model_dir, args.tokenizer_cache_size,
+        args.output_position_only)
+    apply_model_config(args, config)
 
     max_seq_len = config['max_seq_length']
     replace_span = config['replace_span']
+    max_spans = config.get('max_spans')
 
-    label_map = { t: i for i, t in enumerate(labels) }
-    inv_label_map = { v: k for k, v in label_map.items() }
+    if args.bucket_by_length and not has_variable_length_input(model):
+        warning('model has fixed input length, ignoring --bucket_by_length')
+        args.bucket_by_length = False
 
-    test_tok = tokenize_texts(test_texts, tokenizer)
-    test_x = encode_tokenized(test_tok, tokenizer, max_seq_len, replace_span)
+    cache = create_prediction_cache(args.model_dir, args)
 
-    probs = model.predict(test_x, batch_size=args.batch_size)
-    preds = np.argmax(probs, axis=-1)
-    for p in preds:
-        print(inv_label_map[p])
+    if args.probs_output is None:
+        probs_writer = None
+    else:
+        probs_writer = TopKWriter(args.probs_output, labels, args.top_k,
+                                  num_examples(args.test_data))
+
+    if args.test_data.endswith('.npy'):
+        if max_spans:
+            raise NotImplementedError('multi-span prediction from .npy')
+        chunks = npy_chunks(args.test_data, max_seq_len, args.chunk_size)
+    elif args.chunk_size is not None:
+        if max_spans:
+            raise NotImplementedError('streaming multi-span prediction')
+        chunks = stream_encoded(args)
+    else:
+        chunks = None
+
+    if chunks is not None:
+        for x in chunks:
+            probs = predict_encoded(model, x, tokenizer, args, cache)
+            write_predictions(probs, labels, args, probs_writer)
+        if probs_writer is not None:
+            probs_writer.close()
+        if cache is not None:
+            print('Prediction cache: {}'.format(cache), file=sys.stderr)
+        return 0
+
+    if max_spans:
+        keys, _, test_texts = load_grouped_tsv_data(args.test_data, args)
+        groups = group_candidates(keys, test_texts, tokenizer, max_seq_len,
+                                  max_spans, args)
+        test_x, row_index = encode_groups(groups, tokenizer, max_seq_len,
+                                          max_spans, replace_span)
+        predict_fn = lambda x: model.predict(x, batch_size=args.batch_size)
+        if cache is None:
+            probs = predict_fn(test_x)
+        else:
+            probs = cache.predict(predict_fn, test_x)
+        probs = ungroup(probs, row_index, len(test_texts))
+    else:
+        _, test_texts = load_tsv_data(args.test_data, args)
+        test_x = encode_texts(test_texts, tokenizer, max_seq_len, args)
+        probs = predict_encoded(model, test_x, tokenizer, args, cache)
+
+    write_predictions(probs, labels, args, probs_writer)
+    if probs_writer is not None:
+        probs_writer.close()
+    if cache is not None:
+        print('Prediction cache: {}'.format(cache), file=sys.stderr)
     
     return 0
 
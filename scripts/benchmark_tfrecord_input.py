@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Measure examples/sec of the TFRecord training input pipeline without a
+# model, compared to parsing records one at a time.
+
+import sys
+import os
+
+from time import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tensorflow as tf
+
+from common import train_tfrecord_input, get_decode_function
+from config import DEFAULT_SEQ_LEN, DEFAULT_BATCH_SIZE
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    ap.add_argument('--max_seq_length', type=int, default=DEFAULT_SEQ_LEN)
+    ap.add_argument('--steps', type=int, default=1000,
+                    help='Number of batches to time')
+    ap.add_argument('--warmup', type=int, default=50,
+                    help='Number of batches to read before timing')
+    ap.add_argument('--nondeterministic', default=False, action='store_true')
+    ap.add_argument('--cache', default=None,
+                    help='Cache file, or "memory" for in-memory cache')
+    ap.add_argument('--bucket_by_length', default=False, action='store_true')
+    ap.add_argument('data', help='TFRecord file(s), comma-separated')
+    return ap
+
+
+def per_example_input(filenames, max_seq_len, batch_size):
+    # Pipeline before batch parsing, for reference
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.repeat().shuffle(buffer_size=len(filenames))
+    max_concurrent = min(10, len(filenames))
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=max_concurrent,
+        num_parallel_calls=max_concurrent
+    )
+    dataset = dataset.map(get_decode_function(max_seq_len),
+                          num_parallel_calls=10)
+    dataset = dataset.batch(batch_size)
+    return dataset.prefetch(1)
+
+
+def benchmark(dataset, steps, warmup):
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        next(iterator)
+    examples = 0
+    start = time()
+    for _ in range(steps):
+        x, y = next(iterator)
+        examples += int(y.shape[0])
+    return examples, time()-start
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    filenames = args.data.split(',')
+    if args.bucket_by_length:
+        bucket_min_len = int(args.max_seq_length/2) + 1
+    else:
+        bucket_min_len = None
+
+    runs = [
+        ('per-example', per_example_input(
+            filenames, args.max_seq_length, args.batch_size)),
+        ('batched', train_tfrecord_input(
+            filenames, args.max_seq_length, args.batch_size,
+            bucket_min_len=bucket_min_len,
+            deterministic=not args.nondeterministic, cache=args.cache)),
+    ]
+    for name, dataset in runs:
+        examples, elapsed = benchmark(dataset, args.steps, args.warmup)
+        print('{}: {} examples in {:.2f} sec, {:.0f} examples/sec'.format(
+            name, examples, elapsed, examples/elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
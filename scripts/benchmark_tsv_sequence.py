@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Compare batches/sec of TsvSequence against reopening and seeking the
+# TSV file for every batch (load_batch_from_tsv) on synthetic data.
+
+import sys
+import os
+import tempfile
+
+from time import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import TsvSequence, load_batch_offsets, load_batch_from_tsv
+from common import encode_data, get_tokenizer, load_labels
+from config import DEFAULT_SEQ_LEN, DEFAULT_BATCH_SIZE
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--vocab_file', required=True,
+                    help='Vocabulary file that BERT model was trained on')
+    ap.add_argument('--labels', default='example-data/labels.txt',
+                    help='File containing list of labels')
+    ap.add_argument('--lines', type=int, default=200000,
+                    help='Number of lines in synthetic TSV')
+    ap.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    ap.add_argument('--max_seq_length', type=int, default=DEFAULT_SEQ_LEN)
+    ap.add_argument('--read_ahead', type=int, default=4)
+    ap.add_argument('--do_lower_case', default=False, action='store_true')
+    ap.add_argument('--encode', default=False, action='store_true',
+                    help='Include tokenization and encoding in timing')
+    ap.add_argument('data', nargs='?', default='example-data/train.tsv',
+                    help='TSV data to repeat into synthetic input')
+    return ap
+
+
+def write_synthetic(source, num_lines, out):
+    with open(source) as f:
+        lines = f.readlines()
+    for i in range(num_lines):
+        out.write(lines[i % len(lines)])
+    out.flush()
+
+
+def reopen_and_seek(fn, tokenizer, label_map, options):
+    offsets, _ = load_batch_offsets(fn, options.batch_size)
+    for idx, offset in enumerate(offsets):
+        labels, texts = load_batch_from_tsv(fn, idx*options.batch_size,
+                                            offset, options.batch_size,
+                                            options)
+        if options.encode:
+            encode_data(texts, labels, tokenizer, options.max_seq_length,
+                        label_map, options)
+    return len(offsets)
+
+
+def tsv_sequence(fn, tokenizer, label_map, options, read_ahead):
+    seq = TsvSequence(fn, tokenizer, label_map, options.batch_size, options,
+                      read_ahead)
+    for idx in range(len(seq)):
+        if options.encode or read_ahead:
+            seq[idx]
+        else:
+            seq._load_batch(idx)
+    return len(seq)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    args.task_name, args.label_field, args.text_fields = 'NER', -4, -3
+    args.replace_span = '[unused1]'
+    args.tokenizer_cache_size = 0
+    tokenizer = get_tokenizer(args)
+    label_map = { l: i for i, l in enumerate(load_labels(args.labels)) }
+
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv') as tmp:
+        write_synthetic(args.data, args.lines, tmp)
+        runs = [
+            ('reopen-and-seek', lambda: reopen_and_seek(
+                tmp.name, tokenizer, label_map, args)),
+            ('mmap', lambda: tsv_sequence(
+                tmp.name, tokenizer, label_map, args, 0)),
+        ]
+        if args.encode and args.read_ahead:
+            runs.append(('mmap+read_ahead={}'.format(args.read_ahead),
+                         lambda: tsv_sequence(tmp.name, tokenizer, label_map,
+                                              args, args.read_ahead)))
+        for name, run in runs:
+            start = time()
+            batches = run()
+            elapsed = time()-start
+            print('{}: {} batches in {:.2f} sec, {:.1f} batches/sec'.format(
+                name, batches, elapsed, batches/elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
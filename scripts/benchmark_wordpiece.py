@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Check that the trie and substring WordPiece implementations agree
+# token-for-token and compare their speed.
+
+import sys
+import os
+
+from time import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bert_tokenization as tokenization
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--vocab_file', required=True,
+                    help='Vocabulary file that BERT model was trained on')
+    ap.add_argument('--do_lower_case', default=False, action='store_true',
+                    help='Lower case input text (for uncased models)')
+    ap.add_argument('--repeat', type=int, default=5,
+                    help='Number of timed passes over the data')
+    ap.add_argument('data', nargs='+', help='TSV file(s)')
+    return ap
+
+
+def load_words(fn, basic_tokenizer):
+    words = []
+    with open(fn) as f:
+        for l in f:
+            fields = l.rstrip('\n').split('\t')
+            for text in fields[-3:]:
+                words.extend(basic_tokenizer.tokenize(text))
+    return words
+
+
+def tokenize_all(wordpiece_tokenizer, words):
+    return [wordpiece_tokenizer.tokenize(w) for w in words]
+
+
+def benchmark(wordpiece_tokenizer, words, repeat):
+    start = time()
+    for _ in range(repeat):
+        tokenize_all(wordpiece_tokenizer, words)
+    return (time()-start) / repeat
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    vocab = tokenization.load_vocab(args.vocab_file)
+    basic = tokenization.BasicTokenizer(do_lower_case=args.do_lower_case)
+
+    words = []
+    for fn in args.data:
+        words.extend(load_words(fn, basic))
+    print('Loaded {} words from {} files'.format(len(words), len(args.data)),
+          file=sys.stderr)
+
+    start = time()
+    trie = tokenization.WordpieceTokenizer(vocab=vocab, use_trie=True)
+    print('Built trie in {:.2f} sec'.format(time()-start), file=sys.stderr)
+    substr = tokenization.WordpieceTokenizer(vocab=vocab, use_trie=False)
+
+    mismatches = 0
+    for w, t, s in zip(words, tokenize_all(trie, words),
+                       tokenize_all(substr, words)):
+        if t != s:
+            mismatches += 1
+            print('MISMATCH: {}: {} != {}'.format(w, t, s), file=sys.stderr)
+    print('Parity: {}/{} words identical'.format(
+        len(words)-mismatches, len(words)))
+
+    for name, tokenizer in (('substr', substr), ('trie', trie)):
+        elapsed = benchmark(tokenizer, words, args.repeat)
+        print('{}: {:.3f} sec/pass, {:.0f} words/sec'.format(
+            name, elapsed, len(words)/elapsed))
+
+    return 0 if mismatches == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Check that a trained model rebuilt with --output_position_only (see
+# position_only_model() in common.py) predicts the same as the full
+# model on TSV data, and compare their speed.
+
+import sys
+import os
+
+from time import time
+from argparse import ArgumentParser, Namespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import load_model_etc, apply_model_config, load_tsv_data
+from common import encode_texts, position_only_model
+from config import DEFAULT_BATCH_SIZE
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    ap.add_argument('--limit', type=int, default=None,
+                    help='Compare on first N examples only')
+    ap.add_argument('--tolerance', type=float, default=1e-4,
+                    help='Maximum absolute difference in probabilities')
+    ap.add_argument('model_dir')
+    ap.add_argument('data', nargs='?', default='example-data/dev.tsv',
+                    help='TSV data')
+    return ap
+
+
+def timed_predict(model, x, batch_size):
+    model.predict([v[:batch_size] for v in x], batch_size=batch_size)
+    start = time()
+    probs = model.predict(x, batch_size=batch_size)
+    return probs, time()-start
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    model, tokenizer, labels, config = load_model_etc(args.model_dir)
+    if config.get('max_spans'):
+        raise NotImplementedError('checking multi-span models')
+    if config.get('output_position_only'):
+        raise ValueError('{} was trained with output_position_only'.format(
+            args.model_dir))
+    model_options = Namespace()
+    apply_model_config(model_options, config)
+    _, texts = load_tsv_data(args.data, model_options)
+    texts = texts[:args.limit]
+    x = encode_texts(texts, tokenizer, config['max_seq_length'],
+                     model_options)
+
+    full_probs, full_time = timed_predict(model, x, args.batch_size)
+    slim = position_only_model(model, config)
+    slim_probs, slim_time = timed_predict(slim, x, args.batch_size)
+
+    diff = np.max(np.abs(full_probs - slim_probs))
+    agree = np.mean(np.argmax(full_probs, -1) == np.argmax(slim_probs, -1))
+    print('max probability difference {:.2e}, {:.2%} of predictions agree'
+          .format(diff, agree))
+    print('full: {:.1f} examples/sec, output position only: {:.1f} '
+          'examples/sec ({:.2f}x)'.format(len(texts)/full_time,
+                                          len(texts)/slim_time,
+                                          full_time/slim_time))
+    return 0 if diff <= args.tolerance else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Compare accuracy and throughput of a float model and its quantized
+# export (see export_tflite.py) on labeled TSV data.
+
+import sys
+import os
+
+from time import time
+from argparse import ArgumentParser, Namespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import load_model_etc, apply_model_config, load_tsv_data
+from common import encode_texts
+from config import DEFAULT_BATCH_SIZE
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    ap.add_argument('--limit', type=int, default=None,
+                    help='Evaluate on first N examples only')
+    ap.add_argument('float_model_dir')
+    ap.add_argument('quantized_model_dir')
+    ap.add_argument('data', nargs='?', default='example-data/dev.tsv',
+                    help='Labeled TSV data')
+    return ap
+
+
+def evaluate(model_dir, data, options):
+    model, tokenizer, labels, config = load_model_etc(model_dir)
+    model_options = Namespace()
+    apply_model_config(model_options, config)
+    label_map = { l: i for i, l in enumerate(labels) }
+    test_labels, texts = load_tsv_data(data, model_options)
+    test_labels, texts = test_labels[:options.limit], texts[:options.limit]
+    x = encode_texts(texts, tokenizer, config['max_seq_length'],
+                     model_options)
+    y = np.array([label_map[l] for l in test_labels])
+    model.predict([v[:options.batch_size] for v in x],
+                  batch_size=options.batch_size)    # warm up
+    start = time()
+    probs = model.predict(x, batch_size=options.batch_size)
+    elapsed = time()-start
+    preds = np.argmax(probs, axis=-1)
+    return preds, np.mean(preds == y), len(y)/elapsed
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    float_preds, float_acc, float_rate = evaluate(
+        args.float_model_dir, args.data, args)
+    quant_preds, quant_acc, quant_rate = evaluate(
+        args.quantized_model_dir, args.data, args)
+    print('float:     accuracy {:.2%}, {:.1f} examples/sec'.format(
+        float_acc, float_rate))
+    print('quantized: accuracy {:.2%}, {:.1f} examples/sec'.format(
+        quant_acc, quant_rate))
+    print('accuracy delta {:+.2%}, speedup {:.2f}x, {:.2%} of predictions '
+          'agree'.format(quant_acc-float_acc, quant_rate/float_rate,
+                         np.mean(float_preds == quant_preds)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
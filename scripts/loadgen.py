@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Send concurrent requests to a running serve.py instance and report
+# latency percentiles and throughput.
+
+import sys
+import json
+
+from time import time
+from urllib.parse import urlencode
+from urllib.request import urlopen, Request
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--url', default='http://localhost:9000',
+                    help='Server URL')
+    ap.add_argument('--concurrency', type=int, default=32,
+                    help='Number of concurrent clients')
+    ap.add_argument('--requests', type=int, default=1000,
+                    help='Total number of requests')
+    ap.add_argument('--batch', type=int, default=None,
+                    help='Send POST /batch requests of this size')
+    ap.add_argument('data', help='TSV data with left, span, right as last '
+                    'three fields')
+    return ap
+
+
+def load_texts(fn):
+    texts = []
+    with open(fn) as f:
+        for l in f:
+            fields = l.rstrip('\n').split('\t')
+            texts.append(dict(zip(('left', 'span', 'right'), fields[-3:])))
+    return texts
+
+
+def get(url, text):
+    with urlopen('{}/?{}'.format(url, urlencode(text))) as response:
+        return response.read()
+
+
+def post_batch(url, texts):
+    data = json.dumps(texts).encode('utf-8')
+    req = Request('{}/batch'.format(url), data=data,
+                  headers={'Content-Type': 'application/json'})
+    with urlopen(req) as response:
+        return response.read()
+
+
+def percentile(sorted_values, p):
+    i = min(len(sorted_values)-1, int(round(p/100*(len(sorted_values)-1))))
+    return sorted_values[i]
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    texts = load_texts(args.data)
+
+    def send(i):
+        start = time()
+        if args.batch is None:
+            get(args.url, texts[i % len(texts)])
+        else:
+            batch = [texts[(i*args.batch+j) % len(texts)]
+                     for j in range(args.batch)]
+            post_batch(args.url, batch)
+        return time() - start
+
+    start = time()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        latencies = sorted(executor.map(send, range(args.requests)))
+    elapsed = time() - start
+
+    examples = args.requests * (args.batch or 1)
+    print('requests: {}, concurrency: {}, elapsed: {:.1f} sec'.format(
+        args.requests, args.concurrency, elapsed))
+    print('QPS: {:.1f} requests/sec, {:.1f} examples/sec'.format(
+        args.requests/elapsed, examples/elapsed))
+    print('latency: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        1000*percentile(latencies, 50), 1000*percentile(latencies, 99),
+        1000*latencies[-1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
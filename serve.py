@@ -1,13 +1,18 @@
 import os
 import sys
+import queue
+import threading
 
-import tensorflow as tf
+import numpy as np
+
+from time import time
+from concurrent.futures import Future
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
 from common import argument_parser
-from common import load_model
+from common import load_model_etc, create_prediction_cache
 from common import tokenize_texts, encode_tokenized
 
 
@@ -15,39 +20,116 @@ app = Flask(__name__)
 CORS(app)
 
 
+class BatchingPredictor(object):
+    """Collects concurrent requests into batches for the model.
+
+    A batch is run when max_batch_size examples are waiting or when the
+    first of them has waited for max_wait seconds, whichever is first.
+    """
+
+    def __init__(self, model, tokenizer, labels, config, max_batch_size,
+                 max_wait, cache=None):
+        self._model = model
+        self.cache = cache
+        self._tokenizer = tokenizer
+        self._labels = labels
+        self._max_seq_len = config['max_seq_length']
+        self._replace_span = config['replace_span']
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict(self, texts):
+        """Return (tokenized, probabilities) for each (left, span, right)."""
+        tokenized = tokenize_texts(texts, self._tokenizer)
+        futures = []
+        for tokens in tokenized:
+            future = Future()
+            self._queue.put((tokens, future))
+            futures.append(future)
+        return [(t, f.result()) for t, f in zip(tokenized, futures)]
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            futures = [f for _, f in batch]
+            try:
+                x = encode_tokenized([t for t, _ in batch], self._tokenizer,
+                                     self._max_seq_len, self._replace_span)
+                if self.cache is None:
+                    probs = np.asarray(self._model.predict_on_batch(x))
+                else:
+                    probs = self.cache.predict(self._model.predict_on_batch,
+                                               x)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, p in zip(futures, probs):
+                future.set_result(p)
+
+
+def make_response(tokenized, probs, labels):
+    response = { l: float(p) for l, p in zip(labels, list(probs)) }
+    for i, k in enumerate(('left', 'span', 'right')):
+        response[k] = tokenized[i]
+    return response
+
+
 @app.route('/')
 def predict():
     left = request.values['left']
     span = request.values.get('span', '')
     right = request.values['right']
 
-    model, tokenizer, labels, config = (
-        app.model, app.tokenizer, app.labels, app.model_config
-    )
-    max_seq_len = config['max_seq_length']
-    replace_span = config['replace_span']
-    tokenized = tokenize_texts([[left, span, right]], tokenizer)
-    test_x = encode_tokenized(tokenized, tokenizer, max_seq_len, replace_span)
-    with app.graph.as_default():
-        with app.session.as_default():
-            probs = model.predict(test_x)
-    response = { l: float(p) for l, p in zip(labels, list(probs[0])) }
-    for i, k in enumerate(('left', 'span', 'right')):
-        response[k] = tokenized[0][i]
-    return jsonify(response)
+    [(tokenized, probs)] = app.predictor.predict([[left, span, right]])
+    return jsonify(make_response(tokenized, probs, app.labels))
+
+
+@app.route('/batch', methods=['POST'])
+def predict_batch():
+    examples = request.get_json(force=True)
+    if isinstance(examples, dict):
+        examples = examples['examples']
+    texts = [[e['left'], e.get('span', ''), e['right']] for e in examples]
+    results = app.predictor.predict(texts)
+    return jsonify([make_response(t, p, app.labels) for t, p in results])
+
+
+@app.route('/cache')
+def cache_stats():
+    if app.predictor.cache is None:
+        return jsonify({})
+    return jsonify(app.predictor.cache.stats())
 
 
 def main(argv):
     args = argument_parser('serve').parse_args(argv[1:])
-    session = tf.Session()
-    graph = tf.get_default_graph()
-    with graph.as_default():
-        with session.as_default():
-            app.model, app.tokenizer, app.labels, app.model_config = load_model(
-                args.model_dir)
-            app.session = session
-            app.graph = graph
-    app.run(port=args.port, debug=True)
+    model, tokenizer, app.labels, config = load_model_etc(
+        args.model_dir, args.tokenizer_cache_size,
+        args.output_position_only)
+    if config.get('task_name', 'NER') != 'NER' or config.get('max_spans'):
+        raise NotImplementedError('serving supports single-span NER models')
+    cache = create_prediction_cache(args.model_dir, args)
+    app.predictor = BatchingPredictor(model, tokenizer, app.labels, config,
+                                      args.batch_size, args.max_wait_ms/1000,
+                                      cache)
+    app.run(port=args.port, threaded=True)
     return 0
 
 
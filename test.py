@@ -4,27 +4,44 @@ import sys
 import numpy as np
 
 from common import argument_parser
-from common import load_model, load_tsv_data
-from common import tokenize_texts, encode_tokenized
+from common import load_model_etc, apply_model_config, load_tsv_data
+from common import encode_texts, TopKWriter
+from common import load_tfrecords, dataset_labels, load_npy_dataset
 
 
 def main(argv):
     args = argument_parser('test').parse_args(argv[1:])
 
-    model, tokenizer, labels, config = load_model(args.model_dir)
-    test_labels, test_texts = load_tsv_data(args.test_data, args)
+    model, tokenizer, labels, config = load_model_etc(
+        args.model_dir, args.tokenizer_cache_size,
+        args.output_position_only)
+    apply_model_config(args, config)
+    if config.get('max_spans'):
+        raise NotImplementedError('testing multi-span models')
 
     max_seq_len = config['max_seq_length']
-    replace_span = config['replace_span']
 
     label_map = { t: i for i, t in enumerate(labels) }
     inv_label_map = { v: k for k, v in label_map.items() }
 
-    test_tok = tokenize_texts(test_texts, tokenizer)
-    test_x = encode_tokenized(test_tok, tokenizer, max_seq_len, replace_span)
-    test_y = [label_map[l] for l in test_labels]
-
-    probs = model.predict(test_x, batch_size=args.batch_size)
+    test_files = args.test_data.split(',')
+    if test_files[0].endswith('.tfrecord'):
+        test_x = load_tfrecords(test_files, max_seq_len, args.batch_size)
+        test_y = dataset_labels(test_x)
+        probs = model.predict(test_x)
+    elif test_files[0].endswith('.npy'):
+        test_x, test_y = load_npy_dataset(args.test_data, max_seq_len)
+        probs = model.predict(test_x, batch_size=args.batch_size)
+    else:
+        test_labels, test_texts = load_tsv_data(args.test_data, args)
+        test_x = encode_texts(test_texts, tokenizer, max_seq_len, args)
+        test_y = [label_map[l] for l in test_labels]
+        probs = model.predict(test_x, batch_size=args.batch_size)
+    if args.probs_output is not None:
+        probs_writer = TopKWriter(args.probs_output, labels, args.top_k,
+                                  len(test_y))
+        probs_writer.write(probs)
+        probs_writer.close()
     preds = np.argmax(probs, axis=-1)
     correct, total = sum(g==p for g, p in zip(test_y, preds)), len(test_y)
     print('Test accuracy: {:.1%} ({}/{})'.format(
@@ -2,26 +2,75 @@
 
 import sys
 import os
+import json
+import hashlib
 
 import numpy as np
+import tensorflow as tf
 
+from time import time
 from logging import warning
 
 from tensorflow.distribute import MirroredStrategy
-from tensorflow.keras.callbacks import ModelCheckpoint
+from tensorflow.keras.callbacks import LambdaCallback
+from tensorflow.keras.utils import Sequence
 
 from common import argument_parser, print_versions
 from common import load_pretrained, load_model, get_tokenizer, load_labels
 from common import load_dataset, train_tfrecord_input, TsvSequence
-from common import num_examples
+from common import NpySequence, OffsetSequence, load_npy_dataset
+from common import train_tsv_input, tsv_encoding_executor
+from common import load_tfrecords, dataset_labels
+from common import num_examples, check_data_encoding
 from common import create_model, create_optimizer, save_model_etc
-from common import get_checkpoint_files, DeleteOldCheckpoints
+from common import get_checkpoint_files, CheckpointSaver
+from common import is_weights_checkpoint, load_weights_checkpoint
+from common import load_checkpoint_state, set_rng_state
+from common import InputStats, ThroughputLogger
+from common import load_model_etc, DistillationLoss, distillation_accuracy
+from common import pack_distillation_targets, bert_layer_weights
+from common import set_layer_weights, model_fingerprint, is_signed_digit
+from multispan import load_grouped_dataset, ungroup
 
 from config import CHECKPOINT_NAME
 
 
+def create_new_model(num_train_examples, num_labels, global_batch_size,
+                     options, teacher_weights=None):
+    pretrained_model = load_pretrained(options, options.student_layers)
+    if teacher_weights is not None:
+        copied = set_layer_weights(pretrained_model, teacher_weights)
+        print('Initialized {} layers from teacher'.format(copied),
+              file=sys.stderr, flush=True)
+    output_offset = int(options.max_seq_length/2)
+    model = create_model(pretrained_model, num_labels, output_offset,
+                         options.output_layer, options.max_spans,
+                         options.gradient_accumulation_steps,
+                         options.output_position_only)
+    optimizer = create_optimizer(num_train_examples, global_batch_size,
+                                 options)
+    if options.teacher_model_dir is not None:
+        loss = DistillationLoss(options.distill_temperature,
+                                options.distill_alpha)
+        metrics, weighted_metrics = [distillation_accuracy], None
+    elif options.max_spans:
+        # Unused span slots have zero sample weight
+        loss = 'sparse_categorical_crossentropy'
+        metrics, weighted_metrics = None, ['sparse_categorical_accuracy']
+    else:
+        loss = 'sparse_categorical_crossentropy'
+        metrics, weighted_metrics = ['sparse_categorical_accuracy'], None
+    model.compile(
+        optimizer,
+        loss=loss,
+        metrics=metrics,
+        weighted_metrics=weighted_metrics
+    )
+    return model
+
+
 def restore_or_create_model(num_train_examples, num_labels, global_batch_size,
-                            options):
+                            options, teacher_weights=None):
     checkpoints = get_checkpoint_files(options.checkpoint_dir)
     print('Found {} checkpoint files: {}'.format(
         len(checkpoints), checkpoints), file=sys.stderr, flush=True)
@@ -29,25 +78,95 @@ def restore_or_create_model(num_train_examples, num_labels, global_batch_size,
         print('Restoring from checkpoint', checkpoint, file=sys.stderr,
               flush=True)
         try:
-            return load_model(checkpoint)
+            if not is_weights_checkpoint(checkpoint):
+                model = load_model(checkpoint)
+                model.accumulation_steps = options.gradient_accumulation_steps
+                return model, checkpoint
+            model = create_new_model(num_train_examples, num_labels,
+                                     global_batch_size, options,
+                                     teacher_weights)
+            load_weights_checkpoint(model, checkpoint)
+            return model, checkpoint
         except Exception as e:
             warning('Failed to restore from checkpoint {}: {}'.format(
                 checkpoint, e))
 
     # No checkpoint could be loaded
     print('Creating new model', file=sys.stderr, flush=True)
-    pretrained_model = load_pretrained(options)
-    output_offset = int(options.max_seq_length/2)
-    model = create_model(pretrained_model, num_labels, output_offset,
-                         options.output_layer)
-    optimizer = create_optimizer(num_train_examples, global_batch_size,
-                                 options)
-    model.compile(
-        optimizer,
-        loss='sparse_categorical_crossentropy',
-        metrics=['sparse_categorical_accuracy']
-    )
-    return model
+    model = create_new_model(num_train_examples, num_labels, global_batch_size,
+                             options, teacher_weights)
+    return model, None
+
+
+def load_teacher(tokenizer, labels, options):
+    teacher, teacher_tokenizer, teacher_labels, config = load_model_etc(
+        options.teacher_model_dir, 0)
+    if teacher_labels != labels:
+        raise ValueError('teacher labels differ from --labels')
+    if teacher_tokenizer.vocab != tokenizer.vocab:
+        raise ValueError('teacher vocabulary differs from --vocab_file')
+    if config['max_seq_length'] != options.max_seq_length:
+        raise ValueError('teacher max_seq_length {} differs from {}'.format(
+            config['max_seq_length'], options.max_seq_length))
+    return teacher
+
+
+def soft_label_fingerprint(teacher_dir, x):
+    """Return hash of the teacher model and the inputs x."""
+    digest = hashlib.sha1(model_fingerprint(teacher_dir).encode('ascii'))
+    for a in x:
+        a = np.ascontiguousarray(a)
+        digest.update('{} {}'.format(a.dtype, a.shape).encode('ascii'))
+        digest.update(a)
+    return digest.hexdigest()
+
+
+def teacher_soft_labels(teacher, teacher_dir, x, batch_size, cache=None):
+    """Return teacher label probabilities for x, cached in float16.
+
+    The cache is reused only if it was computed by the same teacher
+    model for the same inputs, as recorded in <cache>.json.
+    """
+    if cache is not None:
+        fingerprint = soft_label_fingerprint(teacher_dir, x)
+    if cache is not None and os.path.exists(cache):
+        info_path = cache + '.json'
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                cached_fingerprint = json.load(f).get('fingerprint')
+        else:
+            cached_fingerprint = None
+        if cached_fingerprint == fingerprint:
+            print('Loaded soft labels from {}'.format(cache), file=sys.stderr,
+                  flush=True)
+            return np.load(cache)
+        warning('{} computed by another teacher or for other data, '
+                'recomputing'.format(cache))
+    probs = teacher.predict(x, batch_size=batch_size).astype(np.float16)
+    if cache is not None:
+        with open(cache, 'wb') as out:
+            np.save(out, probs)
+        with open(cache + '.json', 'w') as out:
+            json.dump({ 'fingerprint': fingerprint }, out, indent=4)
+    return probs
+
+
+def timed_predict(model, x, batch_size):
+    """Return predictions for x and the time taken, excluding warm-up."""
+    if isinstance(x, tf.data.Dataset):
+        warm_up = x.take(1)
+    else:
+        warm_up = [v[:batch_size] for v in x]
+    model.predict(warm_up, batch_size=batch_size)
+    start = time()
+    probs = model.predict(x, batch_size=batch_size)
+    return probs, time()-start
+
+
+def sequence_epoch_callback(sequence):
+    # Batch order of Sequence input is determined by seed and epoch
+    return LambdaCallback(
+        on_epoch_begin=lambda epoch, logs: sequence.set_epoch(epoch))
 
 
 def main(argv):
@@ -55,13 +174,17 @@ def main(argv):
     args = argument_parser('train').parse_args(argv[1:])
 
     args.train_data = args.train_data.split(',')
+    if args.dev_data is not None:
+        args.dev_data = args.dev_data.split(',')
     if args.checkpoint_steps is not None:
         os.makedirs(args.checkpoint_dir, exist_ok=True)
 
     strategy = MirroredStrategy()
     num_devices = strategy.num_replicas_in_sync
-    # Batch datasets with global batch size (local * GPUs)
-    global_batch_size = args.batch_size * num_devices
+    # Batch datasets with global batch size (local * GPUs), accumulating
+    # gradients over micro-batches of the local batch size
+    eval_batch_size = args.batch_size * num_devices
+    global_batch_size = eval_batch_size * args.gradient_accumulation_steps
 
     tokenizer = get_tokenizer(args)
 
@@ -71,81 +194,281 @@ def main(argv):
 
     if args.task_name not in (["NER","RE"]):
         raise ValueError("Task not found: {}".format(args.task_name))
+    if args.gradient_accumulation_steps < 1:
+        raise ValueError('--gradient_accumulation_steps must be positive')
+    if args.student_layers is not None:
+        if args.student_layers < 1:
+            raise ValueError('--student_layers must be positive')
+        if (is_signed_digit(args.output_layer) and
+            int(args.output_layer) > args.student_layers):
+            raise ValueError('--output-layer {} is above the {} layers of '
+                             '--student_layers'.format(args.output_layer,
+                                                       args.student_layers))
 
-    if args.train_data[0].endswith('.tsv'):
-        if len(args.train_data) > 1:
-            raise NotImplementedError('Multiple TSV inputs')
+    # Pre-encoded data must match the current tokenization and labels
+    check_data_encoding(args.train_data + (args.dev_data or []), args)
 
-        train_data = TsvSequence(args.train_data[0], tokenizer, label_map,
-                                global_batch_size, args)
-        input_format = 'tsv'
+    distill = args.teacher_model_dir is not None
+    if distill and (args.max_spans or len(args.train_data) > 1 or
+                    not args.train_data[0].endswith(('.tsv', '.npy'))):
+        raise NotImplementedError('distillation requires single .tsv or '
+                                  '.npy training data')
+
+    if args.max_spans:
+        if len(args.train_data) > 1 or not args.train_data[0].endswith('.tsv'):
+            raise NotImplementedError('--max_spans requires single TSV input')
+        train_x, train_y, train_w, _, _ = load_grouped_dataset(
+            args.train_data[0], tokenizer, args.max_seq_length, label_map,
+            args)
+    elif distill:
+        # Same device placement as the student, for comparable speed
+        with strategy.scope():
+            teacher = load_teacher(tokenizer, label_list, args)
+        if args.train_data[0].endswith('.npy'):
+            train_x, train_y = load_npy_dataset(args.train_data[0],
+                                                args.max_seq_length)
+        else:
+            train_x, train_y = load_dataset(args.train_data[0], tokenizer,
+                                            args.max_seq_length, label_map,
+                                            args)
+        train_soft = teacher_soft_labels(teacher, args.teacher_model_dir,
+                                         train_x, eval_batch_size,
+                                         args.soft_labels)
+        train_targets = pack_distillation_targets(train_y, train_soft)
     elif args.train_data[0].endswith('.tfrecord'):
-        train_data = train_tfrecord_input(args.train_data, args.max_seq_length,
-                                          global_batch_size)
-        input_format = 'tfrecord'
+        if args.bucket_by_length:
+            # [PAD] is assumed to have ID 0, as in the standard BERT vocabs
+            bucket_min_len = int(args.max_seq_length/2) + 1
+        else:
+            bucket_min_len = None
+    elif not args.train_data[0].endswith(('.tsv', '.npy')):
+        raise ValueError('--train_data must be .tsv, .tfrecord or .npy')
+
+    if (not args.max_spans and not distill and
+        args.train_data[0].endswith('.tsv') and args.tsv_pipeline == 'tf.data'):
+        # One pool of encoding processes for all inputs made below
+        tsv_executor = tsv_encoding_executor(label_map, args, args.tsv_workers)
     else:
-        raise ValueError('--train_data must be .tsv or .tfrecord')
+        tsv_executor = None
+
+    def make_train_input(skip_batches=0):
+        """Return training input starting after skip_batches batches."""
+        if args.max_spans or distill:
+            if args.max_spans:
+                tensors = (train_x, train_y, train_w)
+            else:
+                tensors = (tuple(train_x), train_targets)
+            train_data = tf.data.Dataset.from_tensor_slices(tensors)
+            train_data = train_data.shuffle(len(train_y), seed=args.seed)
+            train_data = train_data.batch(global_batch_size).repeat()
+            train_data = train_data.skip(skip_batches)
+            steps_per_epoch = int(np.ceil(len(train_y)/global_batch_size))
+            return train_data, 'arrays', steps_per_epoch
+        elif args.train_data[0].endswith('.tfrecord'):
+            train_data = train_tfrecord_input(
+                args.train_data, args.max_seq_length, global_batch_size,
+                bucket_min_len=bucket_min_len,
+                deterministic=not args.nondeterministic_input,
+                cache=args.tfrecord_cache, seed=args.seed,
+                skip_batches=skip_batches)
+            input_format = 'tfrecord'
+        elif (args.train_data[0].endswith('.tsv') and
+              args.tsv_pipeline == 'tf.data'):
+            train_data = train_tsv_input(args.train_data, global_batch_size,
+                                         args, tsv_executor, args.tsv_workers,
+                                         skip_batches=skip_batches)
+            input_format = 'dataset'
+        else:
+            if args.train_data[0].endswith('.tsv'):
+                train_data = TsvSequence(args.train_data, tokenizer, label_map,
+                                         global_batch_size, args,
+                                         args.read_ahead, args.shuffle_tsv,
+                                         args.seed)
+                input_format = 'tsv'
+            else:
+                train_data = NpySequence(args.train_data, global_batch_size,
+                                         args, args.shuffle_tsv, args.seed)
+                input_format = 'npy'
+            steps_per_epoch = len(train_data)
+            if skip_batches % steps_per_epoch:
+                train_data = OffsetSequence(train_data,
+                                            skip_batches % steps_per_epoch)
+            return train_data, input_format, steps_per_epoch
+        steps_per_epoch = int(np.ceil(num_train_examples/global_batch_size))
+        return train_data, input_format, steps_per_epoch
 
     if args.dev_data is None:
         dev_x, dev_y = None, None
         validation_data = None
+    elif args.dev_data[0].endswith('.tfrecord'):
+        if args.max_spans:
+            raise NotImplementedError('--max_spans requires TSV dev data')
+        dev_x = load_tfrecords(args.dev_data, args.max_seq_length,
+                               eval_batch_size)
+        dev_y = dataset_labels(dev_x)
+        validation_data = dev_x
+    elif len(args.dev_data) > 1:
+        raise ValueError('multiple --dev_data files must be .tfrecord')
+    elif args.dev_data[0].endswith('.npy'):
+        if args.max_spans:
+            raise NotImplementedError('--max_spans requires TSV dev data')
+        dev_x, dev_y = load_npy_dataset(args.dev_data[0], args.max_seq_length)
+        validation_data = (dev_x, dev_y)
+    elif args.max_spans:
+        dev_x, dev_slot_y, dev_w, dev_index, dev_y = load_grouped_dataset(
+            args.dev_data[0], tokenizer, args.max_seq_length, label_map, args)
+        validation_data = (dev_x, dev_slot_y, dev_w)
     else:
-        dev_x, dev_y = load_dataset(args.dev_data, tokenizer,
+        dev_x, dev_y = load_dataset(args.dev_data[0], tokenizer,
                                     args.max_seq_length,
                                     label_map, args)
         validation_data = (dev_x, dev_y)
 
+    if distill and validation_data is not None:
+        if isinstance(validation_data, tf.data.Dataset):
+            raise NotImplementedError('distillation requires .tsv or .npy '
+                                      'dev data')
+        dev_soft = teacher.predict(dev_x, batch_size=eval_batch_size)
+        validation_data = (dev_x, pack_distillation_targets(dev_y, dev_soft))
+
+    if isinstance(validation_data, tf.data.Dataset):
+        dev_batch_size = None    # already batched
+    else:
+        dev_batch_size = eval_batch_size
+
     print('Number of devices: {}'.format(num_devices), file=sys.stderr, 
           flush=True)
-    if num_devices > 1 and input_format != 'tfrecord':
-        warning('TFRecord input recommended for multi-device training')
+    if args.gradient_accumulation_steps > 1:
+        print('Effective batch size {} ({} x {} devices x {} accumulation '
+              'steps)'.format(global_batch_size, args.batch_size, num_devices,
+                              args.gradient_accumulation_steps),
+              file=sys.stderr, flush=True)
 
-    num_train_examples = num_examples(args.train_data)
+    if args.max_spans:
+        # Packed sequences, as batched by make_train_input()
+        num_train_examples = len(train_y)
+    else:
+        num_train_examples = num_examples(args.train_data)
     num_labels = len(label_list)
     print('num_train_examples: {}'.format(num_train_examples),
           file=sys.stderr, flush=True)
 
+    teacher_weights = bert_layer_weights(teacher) if distill else None
     with strategy.scope():
-        model = restore_or_create_model(num_train_examples, num_labels, 
-                                        global_batch_size, args)
+        model, checkpoint = restore_or_create_model(
+            num_train_examples, num_labels, global_batch_size, args,
+            teacher_weights)
     model.summary(print_fn=print)
 
+    state = None if checkpoint is None else load_checkpoint_state(checkpoint)
+    if state is None:
+        resume_step = 0
+        if args.seed is None:
+            args.seed = np.random.randint(2**31)
+    else:
+        resume_step = state['global_step']
+        if args.seed is not None and args.seed != state['seed']:
+            warning('ignoring --seed {}, resuming with seed {}'.format(
+                args.seed, state['seed']))
+        args.seed = state['seed']
+        set_rng_state(state['rng'])
+        # Weights-only checkpoints do not include the optimizer step count
+        model.optimizer.iterations.assign(resume_step)
+    tf.random.set_seed(args.seed + resume_step)
+
+    train_data, input_format, steps_per_epoch = make_train_input(resume_step)
+    if num_devices > 1 and input_format == 'tsv':
+        warning('TFRecord input or --tsv_pipeline tf.data recommended for '
+                'multi-device training')
+    if (resume_step and input_format == 'tfrecord' and
+        args.nondeterministic_input):
+        warning('--nondeterministic_input: resumed input order differs')
+
     callbacks = []
     if args.checkpoint_steps is not None:
-        callbacks.append(ModelCheckpoint(
-            filepath=os.path.join(args.checkpoint_dir, CHECKPOINT_NAME),
-            save_freq=args.checkpoint_steps
-        ))
-        callbacks.append(DeleteOldCheckpoints(
-            args.checkpoint_dir, CHECKPOINT_NAME, args.max_checkpoints
+        callbacks.append(CheckpointSaver(
+            args.checkpoint_dir, CHECKPOINT_NAME, args.checkpoint_steps,
+            args.max_checkpoints, args.checkpoint_format,
+            args.async_checkpoints, initial_step=resume_step,
+            extra_state={ 'seed': args.seed }
         ))
 
-    if input_format == 'tsv':
-        other_args = {
-            'workers': 10,    # TODO
-        }
+    if args.profile_start_step is None:
+        profile_steps = None
+    elif args.profile_end_step is None:
+        profile_steps = (args.profile_start_step, args.profile_start_step+10)
     else:
-        assert input_format == 'tfrecord', 'internal error'
-        steps_per_epoch = int(np.ceil(num_train_examples/global_batch_size))
-        other_args = {
-            'steps_per_epoch': steps_per_epoch
-        }
-
-    model.fit(
-        train_data,
-        epochs=args.num_train_epochs,
-        callbacks=callbacks,
-        validation_data=validation_data,
-        validation_batch_size=global_batch_size,
-        **other_args
-    )
+        profile_steps = (args.profile_start_step, args.profile_end_step)
+    if args.log_interval or profile_steps is not None:
+        # Training steps record their batches as they receive them
+        input_stats = InputStats()
+        model.input_stats = input_stats
+        model.input_pad_id = tokenizer.vocab['[PAD]']
+        callbacks.append(ThroughputLogger(
+            input_stats, args.log_interval, args.metrics_file, profile_steps,
+            args.profile_dir, initial_step=resume_step
+        ))
+
+    fit_args = {
+        'validation_data': validation_data,
+        'validation_batch_size': dev_batch_size,
+    }
+    if input_format == 'tsv' and not args.read_ahead:
+        # With --read_ahead, batches must be requested in order by one
+        # worker for the Sequence to read ahead
+        fit_args['workers'] = 10    # TODO
+
+    def fit(train_data, initial_epoch, epochs, steps):
+        if isinstance(train_data, Sequence):
+            # Sequences shuffle batches themselves, see set_epoch()
+            fit_callbacks = callbacks + [sequence_epoch_callback(train_data)]
+            model.fit(train_data, initial_epoch=initial_epoch, epochs=epochs,
+                      callbacks=fit_callbacks, shuffle=False, **fit_args)
+        else:
+            model.fit(train_data, initial_epoch=initial_epoch, epochs=epochs,
+                      callbacks=callbacks, steps_per_epoch=steps, **fit_args)
+
+    initial_epoch, resume_batch = divmod(resume_step, steps_per_epoch)
+    if resume_step:
+        print('Resuming from epoch {} batch {} (step {})'.format(
+            initial_epoch+1, resume_batch, resume_step), file=sys.stderr,
+              flush=True)
+    if resume_batch and initial_epoch < args.num_train_epochs:
+        # Finish the interrupted epoch, then continue with full epochs
+        fit(train_data, initial_epoch, initial_epoch+1,
+            steps_per_epoch-resume_batch)
+        initial_epoch += 1
+        if isinstance(train_data, OffsetSequence):
+            train_data = train_data.sequence
+        else:
+            train_data, _, _ = make_train_input(
+                initial_epoch*steps_per_epoch)
+    if initial_epoch < args.num_train_epochs:
+        fit(train_data, initial_epoch, args.num_train_epochs, steps_per_epoch)
+    if tsv_executor is not None:
+        tsv_executor.shutdown()
 
     if validation_data is not None:
-        probs = model.predict(dev_x, batch_size=global_batch_size)
+        probs, elapsed = timed_predict(model, dev_x, dev_batch_size)
+        if args.max_spans:
+            probs = ungroup(probs, dev_index, len(dev_y))
         preds = np.argmax(probs, axis=-1)
         correct, total = sum(g==p for g, p in zip(dev_y, preds)), len(dev_y)
         print('Final dev accuracy: {:.1%} ({}/{})'.format(
             correct/total, correct, total))
+        if distill:
+            teacher_probs, teacher_elapsed = timed_predict(teacher, dev_x,
+                                                           dev_batch_size)
+            teacher_preds = np.argmax(teacher_probs, axis=-1)
+            teacher_correct = sum(g==p for g, p in zip(dev_y, teacher_preds))
+            print('Teacher dev accuracy: {:.1%} ({}/{}), student {:.1f}x '
+                  'faster ({:.0f} vs {:.0f} examples/sec)'.format(
+                      teacher_correct/total, teacher_correct, total,
+                      teacher_elapsed/elapsed, total/elapsed,
+                      total/teacher_elapsed))
+
+    print('Tokenizer cache: {}'.format(tokenizer.cache_info()),
+          file=sys.stderr, flush=True)
 
     if args.model_dir is not None:
         print('Saving model in {}'.format(args.model_dir))